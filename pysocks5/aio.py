@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+
+# Both ends of the tunnel as asyncio protocols, python 3.7+ only. They
+# speak the same protocol as rsocks5 (see frames.py), so each end can face
+# either implementation, and they run on any asyncio event loop, uvloop
+# included, next to whatever else the application runs on it:
+#
+#   servers = await aio.start_proxy()       # tunnel and socks5 listeners
+#   await aio.start_backdoor()              # keeps the tunnels connected
+#
+# `python aio.py -p|-b [--uvloop]` runs one end on its own.
+#
+# Flow control maps onto the transports: a stream out of credit, or whose
+# tunnel is over its write buffer limit, gets `pause_reading`, and credit
+# for data written to a stream is held back while that stream's transport
+# has paused writing.
+
+import asyncio
+import errno
+import logging
+import random
+import struct
+import sys
+
+import config
+import socks5
+from frames import PROTOCOL_VERSION, HELLO, OPEN, DATA, CLOSE, \
+                   WINDOW_UPDATE, PING, PONG, HEADER, MAX_FRAME, \
+                   PAYLOAD_SIZES
+
+log = logging.getLogger('pysocks5.aio')
+
+class TunnelPool(object):
+    def __init__(self):
+        self.tunnels = []
+        self.next = 0
+
+    def __len__(self):
+        return len(self.tunnels)
+
+    def add(self, tunnel):
+        self.tunnels.append(tunnel)
+
+    def remove(self, tunnel):
+        if tunnel in self.tunnels:
+            self.tunnels.remove(tunnel)
+
+    def pick(self):
+        # fewest streams, then fewest queued bytes, then round-robin
+        n = len(self.tunnels)
+        self.next = (self.next + 1) % n
+        order = self.tunnels[self.next:] + self.tunnels[:self.next]
+        return min(order, key=lambda t: (len(t.streams),
+                   t.transport.get_write_buffer_size()))
+
+class TunnelProtocol(asyncio.Protocol):
+
+    # above the high limit every stream of the tunnel stops reading until
+    # the write buffer drains below the low one
+    high_watermark = 4 * 1024 * 1024
+    low_watermark = 1024 * 1024
+
+    frame_handlers = {
+        HELLO: 'on_hello', OPEN: 'on_open', DATA: 'on_data',
+        CLOSE: 'on_close', WINDOW_UPDATE: 'on_window',
+        PING: 'on_ping', PONG: 'on_pong',
+    }
+
+    def __init__(self, pool=None):
+        self.loop = asyncio.get_event_loop()
+        self.pool = pool
+        self.name = self.__class__.__name__
+        self.transport = None
+        self.streams = {}
+        self.peer_version = None
+        # an incomplete frame, and the size it must reach before it's worth
+        # decoding again
+        self.rest, self.needed = bytearray(), 0
+        self.writing_paused = False
+        self.closed = self.loop.create_future()
+        self.last_recv = self.loop.time()
+        self._ping_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.name += '<%s:%d>' % transport.get_extra_info('peername')[:2]
+        transport.set_write_buffer_limits(self.high_watermark,
+                                          self.low_watermark)
+        self.send_frame(HELLO, 0, struct.pack('>B', PROTOCOL_VERSION))
+        if config.ping_interval:
+            self._ping_handle = self.loop.call_later(config.ping_interval,
+                                                     self._ping_check)
+        if self.pool is not None:
+            self.pool.add(self)
+        log.info('%s created', self.name)
+
+    def connection_lost(self, exc):
+        log.info('%s closed%s', self.name, exc and ': %s' % exc or '')
+        if self._ping_handle:
+            self._ping_handle.cancel()
+        for stream in list(self.streams.values()):
+            stream.close()
+        self.streams.clear()
+        if self.pool is not None:
+            self.pool.remove(self)
+        self.closed.set_result(None)
+
+    def _ping_check(self):
+        silent = self.loop.time() - self.last_recv
+        if silent >= 2 * config.ping_interval:
+            log.warning('%s: no answer from peer for %.0fs', self.name, silent)
+            self.transport.abort()
+            return
+        if silent >= config.ping_interval:
+            self.send_frame(PING, 0, b'')
+        self._ping_handle = self.loop.call_later(config.ping_interval,
+                                                 self._ping_check)
+
+    # frames are decoded in place from the received (immutable) bytes,
+    # payloads are passed on as views of them and only an incomplete frame
+    # left at the end gets copied. The reads completing it are appended to
+    # that copy, which is only decoded again once they add up to the frame.
+    def data_received(self, data):
+        self.last_recv = self.loop.time()
+        if self.rest:
+            self.rest += data
+            if len(self.rest) < self.needed:
+                return
+            data, self.rest = bytes(self.rest), bytearray()
+        view = memoryview(data)
+        i, n = 0, len(view)
+        while n - i >= HEADER.size and not self.transport.is_closing():
+            _type, _id, length = HEADER.unpack_from(view, i)
+            handler = self.frame_handlers.get(_type)
+            if handler is None or length > MAX_FRAME or \
+                    PAYLOAD_SIZES.get(_type, length) != length or \
+                    (_type == HELLO) != (self.peer_version is None):
+                log.error('%s: protocol error, frame type %d', self.name,
+                          _type)
+                self.transport.abort()
+                return
+            end = i + HEADER.size + length
+            if end > n:
+                break
+            getattr(self, handler)(_id, view[i+HEADER.size:end])
+            i = end
+        if i < n:
+            self.rest = bytearray(view[i:])
+            self.needed = HEADER.size
+            if n - i >= HEADER.size:
+                self.needed += HEADER.unpack_from(view, i)[2]
+
+    def pause_writing(self):
+        self.writing_paused = True
+        for stream in list(self.streams.values()):
+            if isinstance(stream, StreamProtocol):
+                stream.update_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        for stream in list(self.streams.values()):
+            if isinstance(stream, StreamProtocol):
+                stream.update_reading()
+
+    def send_frame(self, _type, _id, payload):
+        if not self.transport.is_closing():
+            self.transport.writelines(
+                [HEADER.pack(_type, _id, len(payload)), payload])
+
+    def send_window(self, stream_id, credit):
+        self.send_frame(WINDOW_UPDATE, stream_id, struct.pack('>I', credit))
+
+    def del_stream(self, stream_id, notify=True):
+        self.streams.pop(stream_id, None)
+        if notify:
+            self.send_frame(CLOSE, stream_id, b'')
+
+    def on_hello(self, _id, payload):
+        version = payload[0] if payload else 0
+        if version != PROTOCOL_VERSION:
+            log.error('%s: unsupported protocol version %d', self.name,
+                      version)
+            self.transport.abort()
+            return
+        self.peer_version = version
+
+    def on_open(self, stream_id, payload):
+        log.error('%s: unexpected OPEN frame for %d', self.name, stream_id)
+        self.transport.abort()
+
+    def on_data(self, stream_id, payload):
+        stream = self.streams.get(stream_id)
+        if isinstance(stream, StreamProtocol):
+            stream.write(payload)
+
+    def on_close(self, stream_id, payload):
+        stream = self.streams.get(stream_id)
+        if isinstance(stream, StreamProtocol):
+            stream.close()
+        elif stream is not None:
+            stream.close()
+            self.del_stream(stream_id, notify=False)
+
+    def on_window(self, stream_id, payload):
+        stream = self.streams.get(stream_id)
+        if isinstance(stream, StreamProtocol):
+            stream.send_window += struct.unpack('>I', payload)[0]
+            stream.update_reading()
+
+    def on_ping(self, _id, payload):
+        self.send_frame(PONG, 0, payload)
+
+    def on_pong(self, _id, payload):
+        pass
+
+class LTunnelProtocol(TunnelProtocol):
+    # the proxy end, allocating the stream ids
+
+    def __init__(self, pool=None):
+        TunnelProtocol.__init__(self, pool)
+        self.last_id = 0
+
+    def open_stream(self, stream):
+        stream_id = self.last_id
+        while True:
+            stream_id = stream_id % 0xffffffff + 1
+            if stream_id not in self.streams:
+                break
+        self.last_id = stream_id
+        self.send_frame(OPEN, stream_id, b'')
+        self.streams[stream_id] = stream
+        stream.start(self, stream_id)
+
+class _Handshake(object):
+    # a stream of the backdoor end still talking socks5
+    def __init__(self):
+        self.stage, self.cmd_buf = 0, bytearray()
+        # handshake bytes received from / replied to the client, they take
+        # part in flow control like any other payload
+        self.received, self.replied = 0, 0
+        self.timer = self.task = None
+
+    def close(self):
+        self.timer.cancel()
+        if self.task is not None:
+            self.task.cancel()
+
+class RTunnelProtocol(TunnelProtocol):
+    # the backdoor end, running the socks5 handshakes and connecting out
+
+    def on_open(self, stream_id, payload):
+        if stream_id in self.streams:
+            log.warning('%s: stream %d opened twice', self.name, stream_id)
+            return
+        hs = self.streams[stream_id] = _Handshake()
+        hs.timer = self.loop.call_later(config.handshake_timeout,
+                                        self._timeout, stream_id, hs)
+
+    def on_data(self, stream_id, payload):
+        stream = self.streams.get(stream_id)
+        if isinstance(stream, StreamProtocol):
+            stream.write(payload)
+        elif stream is not None:
+            stream.cmd_buf += payload
+            stream.received += len(payload)
+            # stage 2 waits for the connection, data is just buffered
+            if stream.stage < 2:
+                (self._stage0, self._stage1)[stream.stage](stream_id, stream)
+
+    def _timeout(self, stream_id, hs):
+        if self.streams.get(stream_id) is hs:
+            log.info('%s: handshake timeout for %d', self.name, stream_id)
+            hs.close()
+            self.del_stream(stream_id)
+
+    def _fail(self, stream_id, hs, reply):
+        self.send_frame(DATA, stream_id, reply)
+        hs.close()
+        self.del_stream(stream_id)
+
+    def _stage0(self, stream_id, hs):
+        greeting = socks5.parse_greeting(hs.cmd_buf)
+        if greeting is None:
+            return
+        ver, methods, n = greeting
+        if ver != socks5.VERSION or socks5.METHOD_NO_AUTH not in methods:
+            self._fail(stream_id, hs,
+                       socks5.method_reply(socks5.METHOD_NONE_ACCEPTABLE))
+            return
+        self.send_frame(DATA, stream_id,
+                        socks5.method_reply(socks5.METHOD_NO_AUTH))
+        hs.replied += 2
+        hs.stage = 1
+        del hs.cmd_buf[:n]
+        if hs.cmd_buf:
+            self._stage1(stream_id, hs)
+
+    def _stage1(self, stream_id, hs):
+        try:
+            request = socks5.parse_request(hs.cmd_buf)
+            if request is not None and request[0] != socks5.CMD_CONNECT:
+                raise socks5.Socks5Error(socks5.REP_COMMAND_NOT_SUPPORTED,
+                                         'unsupported command')
+        except socks5.Socks5Error as e:
+            log.info('%s: bad request from %d: %s', self.name, stream_id, e)
+            self._fail(stream_id, hs, socks5.reply(e.rep))
+            return
+        if request is None:
+            return
+        cmd, host, port, n = request
+        if isinstance(host, bytes):
+            try:
+                host = host.decode('idna')
+            except UnicodeError as e:
+                log.info('%s: bad domain name from %d: %s', self.name,
+                         stream_id, e)
+                self._fail(stream_id, hs,
+                           socks5.reply(socks5.REP_HOST_UNREACHABLE))
+                return
+        hs.stage = 2
+        del hs.cmd_buf[:n]
+        hs.task = self.loop.create_task(
+            self._stage2(stream_id, hs, host, port))
+
+    async def _stage2(self, stream_id, hs, host, port):
+        stream = StreamProtocol()
+        connect = self.loop.create_connection(lambda: stream, host, port)
+        try:
+            await asyncio.wait_for(connect, config.connect_timeout or None)
+        except asyncio.TimeoutError:
+            log.info('%s: timed out connecting to %s:%d', self.name, host,
+                     port)
+            if self.streams.get(stream_id) is hs:
+                self._fail(stream_id, hs, socks5.reply(
+                    socks5.connect_error_reply(errno.ETIMEDOUT)))
+            return
+        except OSError as e:
+            log.info('%s: failed to connect to %s:%d: %s', self.name, host,
+                     port, e)
+            rep = socks5.connect_error_reply(e.errno) \
+                if e.errno else socks5.REP_HOST_UNREACHABLE
+            if self.streams.get(stream_id) is hs:
+                self._fail(stream_id, hs, socks5.reply(rep))
+            return
+        if self.streams.get(stream_id) is not hs or \
+                self.transport.is_closing():
+            stream.close()      # closed while connecting
+            return
+
+        hs.timer.cancel()
+        reply = socks5.reply(socks5.REP_SUCCEEDED,
+                             stream.transport.get_extra_info('sockname'))
+        self.send_frame(DATA, stream_id, reply)
+        # the handshake bytes are consumed here, credit them right away,
+        # what's left in `cmd_buf` is credited once it's written upstream
+        self.send_window(stream_id, hs.received - len(hs.cmd_buf))
+        self.streams[stream_id] = stream
+        stream.send_window -= hs.replied + len(reply)
+        stream.start(self, stream_id)
+        if hs.cmd_buf:
+            stream.write(bytes(hs.cmd_buf))
+
+class StreamProtocol(asyncio.Protocol):
+    # one stream's local connection. It doesn't read until `start` has
+    # attached it to its tunnel.
+
+    def __init__(self):
+        self.tunnel, self.id = None, None
+        self.transport = None
+        self.send_window = config.stream_window
+        self.unacked = 0
+        self.reading_paused = True
+        self.writing_paused = False
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.pause_reading()
+
+    def start(self, tunnel, stream_id):
+        self.tunnel, self.id = tunnel, stream_id
+        self.update_reading()
+
+    def update_reading(self):
+        paused = self.send_window <= 0 or self.tunnel.writing_paused or \
+                 self.transport.is_closing()
+        if paused != self.reading_paused:
+            self.reading_paused = paused
+            if paused:
+                self.transport.pause_reading()
+            else:
+                self.transport.resume_reading()
+
+    def data_received(self, data):
+        self.tunnel.send_frame(DATA, self.id, data)
+        self.send_window -= len(data)
+        if self.send_window <= 0:
+            self.update_reading()
+
+    def connection_lost(self, exc):
+        if self.tunnel is not None:
+            self.tunnel.del_stream(self.id, notify=not self.closing)
+
+    # credit is handed back for what the transport accepted without
+    # pausing, and held back while it's over its limits
+    def write(self, data):
+        self.transport.write(data)
+        self.unacked += len(data)
+        self._credit()
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self._credit()
+
+    def _credit(self):
+        if not self.writing_paused and \
+                self.unacked >= config.stream_window // 4:
+            self.tunnel.send_window(self.id, self.unacked)
+            self.unacked = 0
+
+    # closed by the other end of the tunnel: flush and close
+    def close(self):
+        self.closing = True
+        self.transport.close()
+
+class ClientProtocol(StreamProtocol):
+    # a socks5 client of the proxy end, relayed over the least busy tunnel
+
+    def __init__(self, pool):
+        StreamProtocol.__init__(self)
+        self.pool = pool
+
+    def connection_made(self, transport):
+        StreamProtocol.connection_made(self, transport)
+        if not self.pool:
+            log.warning('no tunnel, rejected %s:%d',
+                        *transport.get_extra_info('peername')[:2])
+            transport.close()
+            return
+        self.pool.pick().open_stream(self)
+
+async def start_proxy(tunnel_addr=None, proxy_addr=None, pool=None):
+    """Starts the tunnel and socks5 listeners on the running loop and
+    returns both `asyncio.Server`s"""
+    loop = asyncio.get_event_loop()
+    pool = TunnelPool() if pool is None else pool
+    tunnel_addr = tunnel_addr or (config.tunnel_ip, config.tunnel_port)
+    proxy_addr = proxy_addr or ('0.0.0.0', config.proxy_port)
+    tunnel_server = await loop.create_server(
+        lambda: LTunnelProtocol(pool), *tunnel_addr, reuse_address=True)
+    proxy_server = await loop.create_server(
+        lambda: ClientProtocol(pool), *proxy_addr, reuse_address=True,
+        backlog=config.listen_backlog)
+    log.info('proxy started, tunnels on %s:%d, socks5 on %s:%d',
+             *(tunnel_addr + proxy_addr))
+    return tunnel_server, proxy_server
+
+class Backdoor(object):
+    """Keeps `tunnels` tunnels connected to the proxy at `addr`. A lost
+    tunnel is reconnected at once if it had been up for a while, otherwise
+    after an exponentially growing, jittered delay."""
+
+    min_uptime = 5
+    max_delay = 60
+
+    def __init__(self, addr, tunnels=None):
+        self.addr = addr
+        self.num_tunnels = tunnels or config.tunnels
+        self.pool = TunnelPool()
+
+    async def run(self):
+        await asyncio.gather(*[self._keep(i)
+                               for i in range(self.num_tunnels)])
+
+    async def _keep(self, slot):
+        loop = asyncio.get_event_loop()
+        delay = 0
+        while True:
+            started = loop.time()
+            try:
+                transport, tunnel = await loop.create_connection(
+                    lambda: RTunnelProtocol(self.pool), *self.addr)
+            except OSError as e:
+                log.info('tunnel %d failed to connect: %s', slot, e)
+            else:
+                await tunnel.closed
+            if loop.time() - started < self.min_uptime:
+                delay = min(max(delay * 2, 1), self.max_delay)
+            else:
+                delay = 0
+            wait = delay * random.uniform(0.5, 1)
+            log.info('tunnel %d lost, reconnecting in %.1fs', slot, wait)
+            await asyncio.sleep(wait)
+
+async def start_backdoor(tunnel_addr=None):
+    """Runs the backdoor end until cancelled"""
+    tunnel_addr = tunnel_addr or (config.tunnel_ip, config.tunnel_port)
+    await Backdoor(tunnel_addr).run()
+
+def main(argv):
+    if '--uvloop' in argv:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    level = {'notify': 'critical', 'dump': 'debug'}.get(config.log_level,
+                                                         config.log_level)
+    logging.basicConfig(level=level.upper(),
+                        format='[%(levelname).4s] %(message)s')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        if argv[1:2] in (['-p'], ['--start-proxy']):
+            loop.run_until_complete(start_proxy())
+            loop.run_forever()
+        elif argv[1:2] in (['-b'], ['--start-backdoor']):
+            loop.run_until_complete(start_backdoor())
+        else:
+            sys.stderr.write('usage: aio.py -p|-b [--uvloop]\n')
+            return 2
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
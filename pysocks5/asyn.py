@@ -1,11 +1,15 @@
 #!/env/bin/python
 # -*- coding: utf-8 -*-
 
+import errno
 import socket
 import sys
 
+from buffer import Buffer, Pool
 from eventloop import EV_READ, EV_WRITE, EV_ERROR, EV_TIMEOUT, EV_STOP, Loop
 from logger import Logger
+from sockserver import Connect, Family, SetListenOptions, \
+                       ACCEPT_SKIP_ERRORS, ACCEPT_NOFILE_ERRORS
 
 # user defined methods' name convention:
 #   Method -- public: callable, un-inheritable
@@ -16,54 +20,115 @@ from logger import Logger
 #   _attribute -- hidden
 
 class Socket(Logger):
+
+    # seconds without any successful recv/send before the socket is closed,
+    # 0 disables the idle timer
+    idle_timeout = 0
+
+    # `on_pause_writing` is called once `write_buf` grows above the high
+    # watermark, `on_resume_writing` once it drains to the low one again.
+    # Producers feeding this socket should stop reading in between.
+    high_watermark = 256 * 1024
+    low_watermark = 64 * 1024
+
+    # reads go into pooled buffers of `recv_size` bytes, doubled after a
+    # full read and halved after one that filled less than a quarter of it.
+    # A wakeup reads until the socket is drained or `read_budget` bytes
+    # came in, so that one busy socket can't starve the others.
+    min_recv_size = 4 * 1024
+    max_recv_size = 256 * 1024
+    read_budget = 1024 * 1024
+
+    # with `sock` None, connects to `addr`; socket.error is raised if that
+    # fails at once
     def __init__(self, sock, addr, tag='', event_loop=Loop):
-        if sock is None:            
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setblocking(0)
-            sock.connect_ex(addr)
-        
+        if sock is None:
+            sock = Connect(addr)
+
         self.fd = sock.fileno()
         self.name = '%s<%s:%d>' % (self.__class__.__name__, addr[0], addr[1])
         self.name += tag and ('-'+tag)
         self.sock = sock
         self.event_loop = event_loop
-        self.read_buf = ''
-        self.write_buf = []
+        self.read_buf = Buffer()
+        self.write_buf = Buffer()
         self.sock.setblocking(0)
         self.event_loop.register(self.fd, EV_READ, self._read)
-        self.event_loop.register(self.fd, EV_WRITE, self._write)
         self.event_loop.register(self.fd, EV_ERROR, self._error)
         self.event_loop.register(self.fd, EV_STOP, self._destroy)
         self.closed = False
+        self.reading_paused = False
+        self.writing_paused = False
+        self.recv_size = self.min_recv_size
+        self._destroyed = False
+        self.last_active = self.event_loop.now
+        self._idle_timer = self.idle_timeout and \
+            self.event_loop.call_later(self.idle_timeout, self._idle_check)
         self.info('created')
 
-    def _read(self):
-        try:
-            data = self.sock.recv(4096)
-        except socket.error:
-            self._error()
+    def _idle_check(self):
+        left = self.last_active + self.idle_timeout - self.event_loop.now
+        if left > 0:
+            self._idle_timer = \
+                self.event_loop.call_later(left, self._idle_check)
         else:
-            if data:
-                self.read_buf = self.on_data(data, self.read_buf+data) or ''
-            else:
+            self.on_idle()
+            self.on_close()
+            self._destroy()
+
+    def _read(self):
+        budget = self.read_budget
+        while budget > 0:
+            size = self.recv_size
+            buf = Pool.get(size)
+            try:
+                n = self.sock.recv_into(buf, size)
+            except socket.error as e:
+                Pool.put(buf)
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._error()
+                return
+            if not n:
+                Pool.put(buf)
                 self.on_remote_close()
                 self._destroy()
+                return
+            self.last_active = self.event_loop.now
+            data = memoryview(buf)[:n]
+            self.read_buf.feed(data, self.on_data)
+            del data
+            Pool.put(buf)
+            budget -= n
+            if n < size:
+                if n < size // 4:
+                    self.recv_size = max(size // 2, self.min_recv_size)
+                return      # drained
+            self.recv_size = min(size * 2, self.max_recv_size)
+            if self._destroyed or self.closed or self.reading_paused:
+                return
 
     def _write(self):
         if self.write_buf:
-            data = ''.join(self.write_buf)
+            data = self.write_buf.view()
             try:
                 n = self.sock.send(data)
             except socket.error:
+                del data
                 self._error()
-            else:
-                del self.write_buf[:]
-                if n > 0:
-                    sent, data = data[:n], data[n:]
-                    self.on_sent(sent)
-                if data:
-                    self.write_buf.append(data)
-                    return
+                return
+            if n > 0:
+                self.last_active = self.event_loop.now
+                self.on_sent(data[:n])
+            del data
+            self.write_buf.consume(n)
+            if self.writing_paused and \
+                    len(self.write_buf) <= self.low_watermark:
+                self.writing_paused = False
+                self.on_resume_writing()
+            if self.write_buf:
+                return
+        # only wait for writability while there is something to write
+        self.event_loop.unregister(self.fd, EV_WRITE)
         if self.closed:
             self.on_close()
             self._destroy()
@@ -73,6 +138,9 @@ class Socket(Logger):
         self._destroy()
     
     def _destroy(self):
+        self._destroyed = True
+        if self._idle_timer:
+            self._idle_timer.cancel()
         self.event_loop.unregister_all(self.fd)
         self.sock.close()
         self.on_destroy()
@@ -85,9 +153,36 @@ class Socket(Logger):
             self.on_close()
             self._destroy()
     
+    # stop handling the connection and hand the socket over to the caller,
+    # still open and with nothing registered, whatever is left in
+    # `read_buf`/`write_buf` is the caller's business
+    def Detach(self):
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        self.event_loop.unregister_all(self.fd)
+        self.closed = True
+        return self.sock
+
     def Send(self, data):
         if not self.closed and data:
+            if not self.write_buf:
+                self.event_loop.register(self.fd, EV_WRITE, self._write)
             self.write_buf.append(data)
+            if not self.writing_paused and \
+                    len(self.write_buf) > self.high_watermark:
+                self.writing_paused = True
+                self.on_pause_writing()
+
+    def PauseReading(self):
+        if not self.reading_paused:
+            self.reading_paused = True
+            self.event_loop.unregister(self.fd, EV_READ)
+
+    def ResumeReading(self):
+        if self.reading_paused:
+            self.reading_paused = False
+            if not self.closed:
+                self.event_loop.register(self.fd, EV_READ, self._read)
         
     def on_data(self, data, all_data):
         self.debug('recv', len(data), 'bytes')
@@ -98,11 +193,20 @@ class Socket(Logger):
         self.debug('sent', len(data), 'bytes')
         self.dump(data)
     
+    def on_pause_writing(self):
+        pass
+
+    def on_resume_writing(self):
+        pass
+
     def on_error(self):
         self.error('encountered error')
     
     def on_remote_close(self):
         self.info('closed by remote')
+
+    def on_idle(self):
+        self.info('idle timeout')
     
     def on_close(self):    
         self.info('closed')
@@ -121,7 +225,8 @@ def test_client(server_addr):
             self.Send(s.format(server_addr[0]))
         
         def on_destroy(self):
-            resp = repr(self.read_buf[:20] + ' ... ' + self.read_buf[-20:])
+            buf = self.read_buf.tobytes()
+            resp = repr(buf[:20] + ' ... ' + buf[-20:])
             self.debug('destroyed. received:', resp)
 
     for i in range(3):
@@ -134,16 +239,28 @@ def test_client(server_addr):
     Loop.run()
 
 class Server(Logger):
-    def __init__(self, server_addr, connection_handler=None, num_listens=10):
+
+    # connections accepted per wakeup at most
+    accept_batch = 64
+
+    def __init__(self, server_addr, connection_handler=None, num_listens=128,
+                 defer_accept=0, fast_open=0):
         self.name = self.__class__.__name__ + ('<%s:%d>' % server_addr)
         self.addr = server_addr
         self.connection_handler = connection_handler or self.handle
         self.num_listens = num_listens
+        self.defer_accept, self.fast_open = defer_accept, fast_open
     
     def Run(self, event_loop=Loop):
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            family = Family(self.addr)
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
             self.sock.setblocking(0)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6:
+                self.sock.setsockopt(socket.IPPROTO_IPV6,
+                                     socket.IPV6_V6ONLY, 0)
+            SetListenOptions(self.sock, self.defer_accept, self.fast_open)
             self.sock.bind(self.addr)
             self.sock.listen(self.num_listens)
         except socket.error as e:
@@ -161,11 +278,19 @@ class Server(Logger):
             event_loop.run()
 
     def _accept(self):
-        try:
-            client_sock, client_addr = self.sock.accept()
-        except socket.error:
-            self._error()
-        else:
+        for i in range(self.accept_batch):
+            try:
+                client_sock, client_addr = self.sock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] in ACCEPT_SKIP_ERRORS:
+                    continue
+                if e.args[0] in ACCEPT_NOFILE_ERRORS:
+                    self.warn('accept failed:', e)
+                    return
+                self._error()
+                return
             # It is expected that no exception will be throwed
             # in `self.connection_handler`
             self.connection_handler(client_sock, client_addr, self)
@@ -217,7 +342,7 @@ def test_server(server_addr):
             Socket.on_data(self, data, all_data)
             if len(all_data) < 16:
                 return all_data
-            if all_data.startswith('GET / HTTP/1.1\r\n'):
+            if all_data[:16].tobytes() == 'GET / HTTP/1.1\r\n':
                 self.Send(self.response)
             self.Close()
 
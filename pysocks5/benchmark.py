@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark suite for the tunnel implementations over loopback, python 3:
+#
+#   python3 benchmark.py [--impl NAME ...] [--json PATH] [options]
+#
+# Implementations (--impl, repeatable):
+#   legacy[-POLLER]   rsocks5.py on our own event loop under python 2,
+#                     POLLER is one of epoll, kqueue, poll, select
+#   aio[-uvloop]      aio.py under this interpreter
+#
+# Each one runs as a proxy + backdoor pair on free ports (passed through
+# PYSOCKS5_* environment overrides, see config.py), with local source,
+# sink and echo servers as upstreams. Measured:
+#   connections      connections/s and socks5 handshake latency percentiles
+#   latency          round trip percentiles of small messages on one stream
+#   download/upload  single stream and N stream throughput, with the CPU
+#                    time proxy + backdoor spent per GB
+#   memory           RSS of proxy + backdoor per open idle stream
+# A summary goes to stderr and the results as JSON to --json (stdout by
+# default), to be compared between backends, buffer strategies and
+# revisions.
+
+import argparse
+import json
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+class Upstream(object):
+    """A threaded TCP server on a free loopback port"""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1024)
+        self.addr = self.sock.getsockname()
+        self._spawn(self._serve)
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            self._spawn(self._handle, conn)
+
+    def _handle(self, conn):
+        try:
+            self.handle(conn)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+class SourceServer(Upstream):
+    """Sends `size` bytes to every connection, then closes it"""
+
+    chunk = memoryview(b'\x00' * (256 * 1024))
+
+    def __init__(self, size):
+        self.size = size
+        Upstream.__init__(self)
+
+    def handle(self, conn):
+        left = self.size
+        while left > 0:
+            left -= conn.send(self.chunk[:left])
+
+class SinkServer(Upstream):
+    """Reads a '>Q' byte count and that many bytes, then echoes the count
+    (the tunnel doesn't forward half-closes, so no EOF to wait for)"""
+
+    def handle(self, conn):
+        header = recv_exactly(conn, 8)
+        left, buf = struct.unpack('>Q', header)[0], bytearray(256 * 1024)
+        while left > 0:
+            got = conn.recv_into(buf, min(left, len(buf)))
+            if not got:
+                return
+            left -= got
+        conn.sendall(header)
+
+class EchoServer(Upstream):
+    def handle(self, conn):
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+
+def recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        got = sock.recv(n - len(data))
+        if not got:
+            raise IOError('connection closed')
+        data += got
+    return data
+
+def socks5_connect(proxy_addr, target_addr, timeout=30):
+    """Returns a socket connected to `target_addr` through the proxy"""
+    sock = socket.create_connection(proxy_addr, timeout)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(b'\x05\x01\x00')
+        if recv_exactly(sock, 2) != b'\x05\x00':
+            raise IOError('method rejected')
+        sock.sendall(b'\x05\x01\x00\x01' + socket.inet_aton(target_addr[0]) +
+                     struct.pack('>H', target_addr[1]))
+        reply = recv_exactly(sock, 10)
+        if reply[1] != 0:
+            raise IOError('connect failed, reply %d' % reply[1])
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+def read_all(sock):
+    n, buf = 0, bytearray(256 * 1024)
+    while True:
+        got = sock.recv_into(buf)
+        if not got:
+            return n
+        n += got
+
+def percentiles(values, ps=(50, 90, 99)):
+    values = sorted(values)
+    return dict(('p%d' % p, values[min(len(values) - 1,
+                                       len(values) * p // 100)])
+                for p in ps)
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def proc_cpu(pid):
+    # utime + stime, in seconds
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / \
+        float(os.sysconf('SC_CLK_TCK'))
+
+def proc_rss(pid):
+    # resident set size, in KB
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+class Implementation(object):
+    """A proxy + backdoor pair run as subprocesses"""
+
+    def __init__(self, name, python2):
+        self.name = name
+        kind, _, variant = name.partition('-')
+        self.env = dict(os.environ,
+                        PYSOCKS5_TUNNEL_PORT=str(free_port()),
+                        PYSOCKS5_PROXY_PORT=str(free_port()),
+                        PYSOCKS5_WORKERS='1')
+        if kind == 'legacy':
+            cmd = [python2, 'rsocks5.py']
+            if variant:
+                self.env['PYSOCKS5_POLLER'] = variant
+        elif kind == 'aio':
+            cmd = [sys.executable, 'aio.py']
+        else:
+            raise ValueError('unknown implementation %r' % name)
+        extra = kind == 'aio' and variant and ['--' + variant] or []
+        self.cmds = cmd + ['-p'] + extra, cmd + ['-b'] + extra
+        self.proxy_addr = '127.0.0.1', int(self.env['PYSOCKS5_PROXY_PORT'])
+        self.procs = []
+
+    def __enter__(self):
+        for cmd in self.cmds:
+            self.procs.append(subprocess.Popen(cmd, cwd=HERE, env=self.env,
+                                               stderr=subprocess.DEVNULL))
+            time.sleep(0.3)
+        return self
+
+    def __exit__(self, *exc):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    def cpu(self):
+        return sum(proc_cpu(proc.pid) for proc in self.procs)
+
+    def rss(self):
+        return sum(proc_rss(proc.pid) for proc in self.procs)
+
+    def wait_ready(self, target_addr, timeout=10):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                read_all(socks5_connect(self.proxy_addr, target_addr, 2))
+                return
+            except (IOError, socket.error):
+                if time.time() > deadline or \
+                        any(proc.poll() is not None for proc in self.procs):
+                    raise RuntimeError('%s failed to start' % self.name)
+                time.sleep(0.2)
+
+def run_parallel(n, func, *args):
+    results = [None] * n
+    def run(i):
+        results[i] = func(*args)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+class Suite(object):
+    def __init__(self, args):
+        self.args = args
+        self.source = SourceServer(int(args.size * 1e6))
+        self.tiny = SourceServer(1)
+        self.sink = SinkServer()
+        self.echo = EchoServer()
+
+    def run(self, impl):
+        result = {}
+        with impl:
+            impl.wait_ready(self.tiny.addr)
+            # memory first, before the bulk tests grow the buffers
+            for name in ('connections', 'latency', 'memory', 'download',
+                         'upload'):
+                result[name] = getattr(self, 'bench_' + name)(impl)
+        return result
+
+    def bench_connections(self, impl):
+        handshakes = []
+        start = time.time()
+        for i in range(self.args.connections):
+            t = time.time()
+            sock = socks5_connect(impl.proxy_addr, self.tiny.addr)
+            handshakes.append((time.time() - t) * 1e3)
+            read_all(sock)
+            sock.close()
+        result = {'per_sec': self.args.connections / (time.time() - start)}
+        result['handshake_ms'] = percentiles(handshakes)
+        return result
+
+    def bench_latency(self, impl):
+        sock = socks5_connect(impl.proxy_addr, self.echo.addr)
+        message, rtts = b'x' * 64, []
+        for i in range(self.args.round_trips):
+            t = time.time()
+            sock.sendall(message)
+            recv_exactly(sock, len(message))
+            rtts.append((time.time() - t) * 1e6)
+        sock.close()
+        return {'rtt_us': percentiles(rtts)}
+
+    def _throughput(self, impl, streams, func):
+        cpu, start = impl.cpu(), time.time()
+        n = sum(run_parallel(streams, func, impl))
+        elapsed = time.time() - start
+        return {'streams': streams, 'MB_per_sec': n / elapsed / 1e6,
+                'cpu_sec_per_GB': (impl.cpu() - cpu) / (n / 1e9)}
+
+    def _download(self, impl):
+        sock = socks5_connect(impl.proxy_addr, self.source.addr)
+        try:
+            return read_all(sock)
+        finally:
+            sock.close()
+
+    def _upload(self, impl):
+        sock = socks5_connect(impl.proxy_addr, self.sink.addr)
+        try:
+            chunk, left = SourceServer.chunk, int(self.args.size * 1e6)
+            sock.sendall(struct.pack('>Q', left))
+            while left > 0:
+                left -= sock.send(chunk[:left])
+            return struct.unpack('>Q', recv_exactly(sock, 8))[0]
+        finally:
+            sock.close()
+
+    def bench_download(self, impl):
+        return [self._throughput(impl, 1, self._download),
+                self._throughput(impl, self.args.streams, self._download)]
+
+    def bench_upload(self, impl):
+        return [self._throughput(impl, 1, self._upload),
+                self._throughput(impl, self.args.streams, self._upload)]
+
+    def bench_memory(self, impl):
+        n = self.args.idle_streams
+        time.sleep(0.5)
+        before = impl.rss()
+        socks = []
+        try:
+            for i in range(n):
+                sock = socks5_connect(impl.proxy_addr, self.echo.addr)
+                socks.append(sock)
+                sock.sendall(b'x')
+                recv_exactly(sock, 1)
+            after = impl.rss()
+        finally:
+            for sock in socks:
+                sock.close()
+        return {'streams': n, 'rss_KB': after,
+                'KB_per_stream': (after - before) / float(n)}
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def summary(results):
+    lines = []
+    for name, r in results.items():
+        down, up = r['download'], r['upload']
+        lines.append(
+            '%-14s %7.0f conn/s  handshake p50 %.2fms p99 %.2fms  '
+            'rtt p50 %.0fus\n%-14s down %.0f/%.0f MB/s (%.1f/%.1f cpu s/GB)  '
+            'up %.0f/%.0f MB/s  %.1f KB/stream' % (
+                name, r['connections']['per_sec'],
+                r['connections']['handshake_ms']['p50'],
+                r['connections']['handshake_ms']['p99'],
+                r['latency']['rtt_us']['p50'], '',
+                down[0]['MB_per_sec'], down[1]['MB_per_sec'],
+                down[0]['cpu_sec_per_GB'], down[1]['cpu_sec_per_GB'],
+                up[0]['MB_per_sec'], up[1]['MB_per_sec'],
+                r['memory']['KB_per_stream']))
+    return '\n'.join(lines) + '\n'
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='tunnel benchmark suite')
+    parser.add_argument('--impl', action='append', dest='impls',
+                        help='implementation to run (repeatable), '
+                             'default: legacy and aio')
+    parser.add_argument('--python2', default='python2',
+                        help='interpreter for the legacy implementation')
+    parser.add_argument('--size', type=float, default=100,
+                        help='MB transferred per bulk stream')
+    parser.add_argument('--streams', type=int, default=8,
+                        help='parallel streams in the N stream tests')
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--round-trips', type=int, default=2000)
+    parser.add_argument('--idle-streams', type=int, default=200)
+    parser.add_argument('--json', default='-',
+                        help='where to write the results, - for stdout')
+    args = parser.parse_args(argv[1:])
+
+    suite = Suite(args)
+    results = {}
+    for name in args.impls or ['legacy', 'aio']:
+        sys.stderr.write('running %s\n' % name)
+        results[name] = suite.run(Implementation(name, args.python2))
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': revision(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'params': vars(args),
+        'results': results,
+    }
+    sys.stderr.write(summary(results))
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main(sys.argv)
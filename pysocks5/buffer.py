@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# A byte queue backed by one `bytearray` and a consumed offset. Appending
+# copies the new data once, consuming only moves the offset, and the dead
+# head is dropped in bulk when it grows past half of the storage, so both
+# operations are amortized O(len(data)) without re-copying the unsent tail.
+#
+# Views returned by `view` pin the storage (a `bytearray` with exported
+# buffers can't be resized), drop them before calling `append`/`consume`.
+# If one is kept anyway, the storage is swapped for a fresh copy instead.
+
+class Buffer(object):
+    __slots__ = 'buf', 'pos'
+
+    # don't bother compacting heads smaller than this
+    compact_size = 64 * 1024
+
+    def __init__(self, data=b''):
+        self.buf = bytearray(data)
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.buf) - self.pos
+
+    def append(self, data):
+        try:
+            self.buf += data
+        except BufferError:
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+
+    def view(self):
+        return memoryview(self.buf)[self.pos:]
+
+    def tobytes(self):
+        return bytes(self.buf[self.pos:])
+
+    def consume(self, n):
+        self.pos += n
+        if self.pos >= len(self.buf):
+            self.clear()
+        elif self.pos > self.compact_size and self.pos * 2 > len(self.buf):
+            try:
+                del self.buf[:self.pos]
+            except BufferError:
+                self.buf = self.buf[self.pos:]
+            self.pos = 0
+
+    def clear(self):
+        try:
+            del self.buf[:]
+        except BufferError:
+            self.buf = bytearray()
+        self.pos = 0
+
+    def feed(self, data, on_data):
+        # `on_data(data, all_data)` gets memoryviews of the new chunk and of
+        # everything buffered so far, and returns the unconsumed tail of
+        # `all_data` (or None/'' if it used it all). When nothing is
+        # buffered the chunk itself is passed on, and only the tail left
+        # over by `on_data` gets copied.
+        data = memoryview(data)
+        if self.pos == len(self.buf):
+            rest = on_data(data, data)
+            if rest:
+                self.append(rest)
+            return
+        self.append(data)
+        all_data = self.view()
+        rest = on_data(data, all_data)
+        n = len(all_data) - len(rest or b'')
+        del data, all_data, rest
+        self.consume(n)
+
+# Free lists of preallocated `bytearray`s for `recv_into`, one list per
+# power-of-two size. Whatever is read into a pooled buffer must be consumed
+# or copied before the buffer goes back with `put`.
+
+class BufferPool(object):
+
+    # free buffers kept per size
+    max_free = 16
+
+    def __init__(self):
+        self.free = {}
+
+    def get(self, size):
+        """Returns a bytearray of at least `size` bytes"""
+        n = 1
+        while n < size:
+            n <<= 1
+        free = self.free.get(n)
+        return free.pop() if free else bytearray(n)
+
+    def put(self, buf):
+        free = self.free.setdefault(len(buf), [])
+        if len(free) < self.max_free:
+            free.append(buf)
+
+Pool = BufferPool()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import time
+import zlib
+
+import metrics
+
+# Compression of the payloads a stream sends over the tunnel, with one
+# deflate stream per stream and direction: each ZDATA frame (see frames.py)
+# carries the compressor output for one chunk, sync-flushed so that the
+# peer can decompress it as soon as it arrives.
+#
+# A stream only gets a compressor once it sends a chunk of `min_size`
+# bytes or more, the small ones before that go out as they are, and that
+# compressor is cut down to a 4KB window and small hash tables, about 32KB
+# instead of zlib's 256KB for a ratio within a percent of it. As soon as
+# the stream's chunks have not shrunk at all, or once `probe` bytes went
+# through and they didn't shrink below `max_ratio` of their size (TLS,
+# media, archives), it is given up on: that chunk and all the following
+# ones are sent as plain DATA frames, which also tells the peer to drop
+# its decompressor.
+
+_time = getattr(time, 'monotonic', time.time)
+
+class StreamCompressor(object):
+    __slots__ = 'level', 'compressor', 'given_up', 'raw', 'compressed', \
+                'seconds'
+
+    wbits, mem_level = 12, 5
+    min_size = 512
+    probe = 16 * 1024
+    max_ratio = 0.9
+
+    def __init__(self, level):
+        self.level = level
+        self.compressor = None
+        self.given_up = False
+        self.raw, self.compressed = 0, 0    # of the chunks sent compressed
+        self.seconds = 0.0
+
+    def Compress(self, data):
+        """Returns `data` compressed, or None for it to be sent as is"""
+        if self.given_up:
+            return None
+        if self.compressor is None:
+            if len(data) < self.min_size:
+                return None
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                               self.wbits, self.mem_level)
+        if isinstance(data, memoryview):
+            data = data.tobytes()   # python2's zlib only takes strings
+        start = _time()
+        out = self.compressor.compress(data) + \
+            self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        elapsed = _time() - start
+        self.seconds += elapsed
+        metrics.COMPRESS_SECONDS.inc(elapsed)
+        raw, compressed = self.raw + len(data), self.compressed + len(out)
+        if compressed >= raw or \
+                (raw >= self.probe and compressed > self.max_ratio * raw):
+            self.compressor = None
+            self.given_up = True
+            metrics.COMPRESS_GIVEN_UP.inc()
+            return None
+        self.raw, self.compressed = raw, compressed
+        metrics.COMPRESS_IN.inc(len(data))
+        metrics.COMPRESS_OUT.inc(len(out))
+        return out
+
+    # as structured log fields
+    def Stats(self):
+        return {'raw_bytes': self.raw, 'compressed_bytes': self.compressed,
+                'ratio': round(float(self.compressed) / self.raw, 3),
+                'compress_ms': round(self.seconds * 1000, 3),
+                'given_up': self.given_up}
+
+# returns the payload of a ZDATA frame decompressed, or None if it is
+# corrupt or would be larger than `max_size`
+def decompress(decompressor, payload, max_size):
+    if isinstance(payload, memoryview):
+        payload = payload.tobytes()
+    try:
+        out = decompressor.decompress(payload, max_size)
+    except zlib.error:
+        return None
+    if decompressor.unconsumed_tail:
+        return None
+    return out
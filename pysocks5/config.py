@@ -2,5 +2,61 @@
 
 tunnel_ip = '127.0.0.1'
 tunnel_port = 8187
+proxy_ip = '0.0.0.0'        # '::' takes IPv6 and IPv4 clients
 proxy_port = 8188
+listen_backlog = 4096       # pending connections per listener, capped by somaxconn
+defer_accept = 0            # seconds, > 0 wakes up for clients only once they send
+fast_open = 0               # TCP fast open queue length, 0 disables
 log_level = 'warn'
+log_format = 'text'         # 'text' or 'json' lines
+log_rate = 100              # messages per second and kind, 0 for no limit
+log_buffered = True         # write logs from a background thread, in batches
+idle_timeout = 0            # seconds, 0 keeps idle streams open forever
+handshake_timeout = 30      # seconds for a client to finish the socks5 handshake
+connect_timeout = 10        # seconds to connect upstream, or a tunnel to the proxy
+stream_window = 256 * 1024  # bytes in flight per stream and direction
+compress_level = 0          # zlib level 1-9 for data sent over tunnels, 0 disables
+stream_weights = {}         # {port: weight}, backdoor egress share of streams to port
+flush_delay = 0             # seconds tunnel writes may wait to be batched, 0 for none
+# socket options of the tunnels, the socks5 clients and the requested hosts:
+# nodelay, quickack, keepalive, sndbuf, rcvbuf (see SetSocketOptions)
+sock_opts = {'tunnel': {'nodelay': 1}, 'client': {'nodelay': 1},
+             'upstream': {'nodelay': 1}}
+nameservers = None          # [(ip, port), ...], None reads /etc/resolv.conf
+dns_timeout = 2             # seconds before a dns query is retried
+ipv6 = True                 # resolve and connect to IPv6 addresses as well
+workers = 1                 # > 1 runs that many prefork worker processes
+tunnels = 1                 # parallel tunnel connections per worker
+udp_associate = True        # allow the socks5 UDP ASSOCIATE command
+udp_timeout = 120           # seconds a destination may stay silent before its replies are dropped
+warm_sockets = 0            # connected sockets kept per recent upstream, 0 disables
+warm_hosts = []             # [(ip, port), ...] kept warm even when unused
+warm_idle = 60              # seconds an upstream stays warm after its last use
+warm_hot = 3                # connects, each within warm_idle of the last, before an upstream is warmed
+warm_max_age = 20           # seconds before a warm socket is replaced
+ping_interval = 30          # seconds of tunnel silence before a ping, 0 disables
+poller = None               # 'epoll', 'kqueue', 'poll', 'select', None picks the best
+metrics_ip = '127.0.0.1'
+metrics_port = 0            # http port serving /metrics, 0 disables
+profile = False             # time every event loop callback, see profiler.py
+slow_callback = 0.1         # seconds, profiled callbacks taking longer are logged
+profile_samples = None      # file for sampled stacks (flamegraph collapsed format)
+
+# Any setting above can be overridden from the environment with a python
+# literal (plain words are taken as strings), e.g. PYSOCKS5_PROXY_PORT=1080
+# or PYSOCKS5_NAMESERVERS="[('8.8.8.8', 53)]".
+
+import ast as _ast
+import os as _os
+
+def _override(settings, environ):
+    for name in list(settings):
+        value = environ.get('PYSOCKS5_' + name.upper())
+        if name.startswith('_') or value is None:
+            continue
+        try:
+            settings[name] = _ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            settings[name] = value
+
+_override(globals(), _os.environ)
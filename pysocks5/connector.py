@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import socket
+
+from eventloop import EV_WRITE
+from logger import Logger
+from sockserver import Family
+
+import config
+
+# Happy eyeballs (RFC 8305): connects to the first of `addrs` and, if that
+# hasn't succeeded within `attempt_delay`, to the next one as well, and so
+# on, without dropping the attempts still in flight. A failed attempt moves
+# on to the next address at once. The first connection to complete wins
+# and the others are closed, so the time to connect is that of the fastest
+# reachable address rather than the sum of the timeouts of the dead ones.
+# Completion is detected through writability and SO_ERROR. After `timeout`
+# seconds (0 for none) whatever is still in flight is given up on.
+#
+# `callback(sock, addr, err)` gets the connected socket and its address, or
+# None, None and the errno of the last failed attempt (ETIMEDOUT once the
+# time is up).
+
+_IN_PROGRESS = 0, errno.EINPROGRESS, errno.EWOULDBLOCK
+
+def _connect(addr):
+    try:
+        sock = socket.socket(Family(addr), socket.SOCK_STREAM)
+    except socket.error as e:       # e.g. no IPv6 on this host
+        return None, e.args[0]
+    sock.setblocking(0)
+    err = sock.connect_ex(addr)
+    if err not in _IN_PROGRESS:
+        sock.close()
+        return None, err
+    return sock, 0
+
+class Connector(Logger):
+
+    level = config.log_level
+
+    attempt_delay = 0.25
+
+    def __init__(self, event_loop, addrs, callback, name='Connector',
+                 timeout=0):
+        self.name = name
+        self.event_loop = event_loop
+        self.pending = list(addrs)
+        self.callback = callback
+        self.attempts = {}      # fd -> (sock, addr)
+        self.timer = None
+        self.deadline = timeout and \
+            event_loop.call_later(timeout, self._on_timeout)
+        self.error = errno.EHOSTUNREACH
+        self._next()
+
+    def Cancel(self):
+        if self.deadline:
+            self.deadline.cancel()
+            self.deadline = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for fd, (sock, addr) in list(self.attempts.items()):
+            self.event_loop.unregister_all(fd)
+            sock.close()
+        self.attempts.clear()
+        self.pending = []
+
+    def _next(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.pending:
+            addr = self.pending.pop(0)
+            sock, err = _connect(addr)
+            if sock is None:
+                self.debug('failed to connect to', addr[0], err)
+                self.error = err
+                continue
+            fd = sock.fileno()
+            self.attempts[fd] = sock, addr
+            self.event_loop.register(fd, EV_WRITE,
+                                     lambda: self._on_writable(fd))
+            if self.pending:
+                self.timer = self.event_loop.call_later(self.attempt_delay,
+                                                        self._next)
+            return
+        if not self.attempts:
+            self.Cancel()
+            self.callback(None, None, self.error)
+
+    def _on_timeout(self):
+        self.deadline = None
+        self.info('timed out connecting')
+        self.Cancel()
+        self.callback(None, None, errno.ETIMEDOUT)
+
+    def _on_writable(self, fd):
+        sock, addr = self.attempts.pop(fd)
+        self.event_loop.unregister_all(fd)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.debug('failed to connect to', addr[0], err)
+            sock.close()
+            self.error = err
+            self._next()
+            return
+        self.Cancel()
+        self.callback(sock, addr, 0)
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import socket
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from asyn import Socket, Server
+from connector import Connector
+from eventloop import EV_READ, EV_WRITE, EV_STOP, Loop
+from logger import Logger
+from profiler import start_profiler
+from resolver import GetResolver
+from sockserver import SetSocketOptions
+from udprelay import ClientRelay, Association, unmap
+
+import config
+import metrics
+import socks5
+
+# Direct mode: a plain SOCKS5 server connecting to the requested hosts by
+# itself, no tunnel involved. Once a CONNECT succeeds, the client and the
+# upstream sockets are handed over to a `Relay`. A UDP ASSOCIATE wires a
+# `ClientRelay` straight to an `Association` (see udprelay.py), both closed
+# along with the control connection.
+
+def start_direct(event_loop=Loop):
+    metrics.start_metrics(0, event_loop)
+    start_profiler(0, event_loop)
+    Server((config.proxy_ip, config.proxy_port), Socks5Handler,
+           num_listens=config.listen_backlog,
+           defer_accept=config.defer_accept,
+           fast_open=config.fast_open).Run(event_loop)
+
+class Socks5Handler(Socket):
+
+    level = config.log_level
+
+    def __init__(self, sock, addr, server_obj):
+        Socket.__init__(self, sock, addr, '', server_obj.event_loop)
+        self.stage = 0
+        self.connector = None
+        self.udp = self.association = None
+        self.destroyed = False
+        self.resolver = GetResolver(self.event_loop,
+                                    nameservers=config.nameservers,
+                                    timeout=config.dns_timeout,
+                                    ipv6=config.ipv6)
+        self.timer = self.event_loop.call_later(config.handshake_timeout,
+                                                self._timeout)
+
+    def _timeout(self):
+        self.info('handshake timeout')
+        metrics.HANDSHAKE_FAILURES['timeout'].inc()
+        self.Close()
+
+    def _fail(self, rep):
+        self.Send(socks5.reply(rep))
+        self.Close()
+
+    def on_data(self, data, all_data):
+        if self.stage == 0:
+            greeting = socks5.parse_greeting(all_data)
+            if greeting is None:
+                return all_data
+            ver, methods, n = greeting
+            if ver != socks5.VERSION or socks5.METHOD_NO_AUTH not in methods:
+                metrics.HANDSHAKE_FAILURES['method'].inc()
+                self.Send(socks5.method_reply(socks5.METHOD_NONE_ACCEPTABLE))
+                self.Close()
+                return
+            self.Send(socks5.method_reply(socks5.METHOD_NO_AUTH))
+            self.stage = 1
+            all_data = all_data[n:]
+
+        if self.stage == 1:
+            try:
+                request = socks5.parse_request(all_data)
+                if request is not None and \
+                        request[0] not in self._commands():
+                    raise socks5.Socks5Error(
+                        socks5.REP_COMMAND_NOT_SUPPORTED, 'unsupported command')
+            except socks5.Socks5Error as e:
+                self.info('bad request:', e)
+                metrics.HANDSHAKE_FAILURES['request'].inc()
+                self._fail(e.rep)
+                return
+            if request is None:
+                return all_data
+            cmd, host, port, n = request
+            if cmd == socks5.CMD_UDP_ASSOCIATE:
+                self._associate()
+                return
+            # whatever the client sends early waits in `read_buf` until the
+            # relay starts
+            self.stage = 2
+            self.PauseReading()
+            self.resolver.Resolve(host,
+                                  lambda addrs: self._connect(addrs, port))
+            return all_data[n:]
+
+        # nothing more is expected on the control connection of an
+        # association
+        return None if self.stage == 3 else all_data
+
+    def _commands(self):
+        if config.udp_associate:
+            return socks5.CMD_CONNECT, socks5.CMD_UDP_ASSOCIATE
+        return socks5.CMD_CONNECT,
+
+    def _associate(self):
+        self.timer.cancel()
+        self.stage = 3
+        try:
+            self.udp = ClientRelay(self.event_loop,
+                                   unmap(self.sock.getsockname()[0]),
+                                   self.sock.getpeername()[0],
+                                   self._on_client_datagram, self.name)
+        except socket.error as e:
+            self.warn('failed to relay udp:', e)
+            self._fail(socks5.REP_GENERAL_FAILURE)
+            return
+        self.association = Association(self.event_loop, self.resolver,
+                                       self.udp.SendTo, config.udp_timeout,
+                                       self.name)
+        self.Send(socks5.reply(socks5.REP_SUCCEEDED, self.udp.addr))
+
+    def _on_client_datagram(self, payload):
+        self.association.Send(payload)
+
+    def _connect(self, addrs, port):
+        if self.destroyed:
+            return
+        if not addrs:
+            metrics.HANDSHAKE_FAILURES['resolve'].inc()
+            self._fail(socks5.REP_HOST_UNREACHABLE)
+            return
+        self.connector = Connector(self.event_loop,
+                                   [(addr, port) for addr in addrs],
+                                   self._on_connected, self.name,
+                                   config.connect_timeout)
+
+    def _on_connected(self, sock, addr, err):
+        self.connector = None
+        if sock is None:
+            self.info('failed to connect:', os.strerror(err))
+            metrics.HANDSHAKE_FAILURES['connect'].inc()
+            self._fail(socks5.connect_error_reply(err))
+            return
+        self.timer.cancel()
+        self.Send(socks5.reply(socks5.REP_SUCCEEDED, sock.getsockname()))
+        early, reply = self.read_buf.tobytes(), self.write_buf.tobytes()
+        client = self.Detach()
+        SetSocketOptions(client, config.sock_opts.get('client', {}))
+        SetSocketOptions(sock, config.sock_opts.get('upstream', {}))
+        Relay(self.event_loop, client, sock, early, reply, self.name, addr)
+
+    def on_destroy(self):
+        self.destroyed = True
+        self.timer.cancel()
+        if self.connector is not None:
+            self.connector.Cancel()
+        if self.udp is not None:
+            self.udp.Close()
+        if self.association is not None:
+            self.association.Cancel()
+
+# Moves the bytes of an established connection both ways until both ends
+# are done. With `os.splice` (linux, python 3.10+) they go through a pipe
+# and never reach user space. Otherwise they are read with `recv_into` into
+# one large buffer shared by all relays, and only what the destination
+# doesn't take right away is copied aside.
+class Relay(Logger):
+
+    level = config.log_level
+
+    # `addr` is where `b` connected to, only for logging: by now `b` may
+    # have been reset, and getpeername() would fail
+    def __init__(self, event_loop, a, b, a_to_b=b'', b_to_a=b'',
+                 name='Relay', addr=None):
+        self.name = name
+        self.event_loop = event_loop
+        self.socks = a, b
+        self.closed = False
+        Link = _SpliceLink if _splice else _CopyLink
+        self.links = Link(self, a, b, a_to_b), Link(self, b, a, b_to_a)
+        event_loop.register(a.fileno(), EV_STOP, self.Close)
+        metrics.STREAMS.inc()
+        metrics.STREAMS_OPENED.inc()
+        if addr:
+            self.info('relaying to', '%s:%d' % addr[:2])
+        for link in self.links:
+            if not self.closed:
+                link.Start()
+
+    def on_link_done(self, link):
+        if all(link.done for link in self.links):
+            self.Close()
+
+    def on_link_error(self, link, e):
+        self.info('error:', e)
+        self.Close()
+
+    def Close(self):
+        if self.closed:
+            return
+        self.closed = True
+        metrics.STREAMS.dec()
+        for link in self.links:
+            link.close()
+        for sock in self.socks:
+            self.event_loop.unregister_all(sock.fileno())
+            sock.close()
+        self.info('closed', bytes_up=self.links[0].count,
+                  bytes_down=self.links[1].count)
+
+_splice = getattr(os, 'splice', None)
+_SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | \
+                getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+_AGAIN = errno.EAGAIN, errno.EWOULDBLOCK
+
+class _Link(object):
+    # one direction of a relay: `head` first, then whatever `src` sends,
+    # until it shuts down. While `dst` can't keep up, `src` isn't read.
+    def __init__(self, relay, src, dst, head):
+        self.relay, self.event_loop = relay, relay.event_loop
+        self.src, self.dst = src, dst
+        self.src_fd, self.dst_fd = src.fileno(), dst.fileno()
+        self.head = memoryview(head)
+        self.eof = self.done = False
+        self.count = 0
+
+    def Start(self):
+        self._flush()
+
+    def _read(self):
+        try:
+            n = self.fill()
+        except (socket.error, OSError) as e:
+            if e.args[0] not in _AGAIN:
+                self.relay.on_link_error(self, e)
+            return
+        self.count += n
+        metrics.STREAM_RECEIVED.inc(n)
+        self.eof = not n
+        self._flush()
+
+    def _flush(self):
+        try:
+            flushed = self._send_head() and self.flush()
+        except (socket.error, OSError) as e:
+            self.relay.on_link_error(self, e)
+            return
+        if not flushed:
+            self.event_loop.unregister(self.src_fd, EV_READ)
+            self.event_loop.register(self.dst_fd, EV_WRITE, self._flush)
+            return
+        self.event_loop.unregister(self.dst_fd, EV_WRITE)
+        if not self.eof:
+            self.event_loop.register(self.src_fd, EV_READ, self._read)
+            return
+        self.event_loop.unregister(self.src_fd, EV_READ)
+        try:
+            self.dst.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self.done = True
+        self.relay.on_link_done(self)
+
+    def _send_head(self):
+        while self.head:
+            try:
+                n = self.dst.send(self.head)
+            except socket.error as e:
+                if e.args[0] in _AGAIN:
+                    return False
+                raise
+            metrics.STREAM_SENT.inc(n)
+            self.head = self.head[n:]
+        return True
+
+    # `fill` reads what's available from `src` and returns the byte count,
+    # 0 at EOF, `flush` writes as much as possible of it to `dst` and tells
+    # whether everything went through
+    def fill(self):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+_copy_buf = bytearray(256 * 1024)
+_copy_view = memoryview(_copy_buf)
+
+class _CopyLink(_Link):
+    def __init__(self, relay, src, dst, head):
+        _Link.__init__(self, relay, src, dst, head)
+        self.pending = None
+        self.shared = False
+
+    def fill(self):
+        n = self.src.recv_into(_copy_buf)
+        self.pending, self.shared = _copy_view[:n], True
+        return n
+
+    def flush(self):
+        pending = self.pending
+        while pending:
+            try:
+                n = self.dst.send(pending)
+            except socket.error as e:
+                if e.args[0] not in _AGAIN:
+                    raise
+                break
+            metrics.STREAM_SENT.inc(n)
+            pending = pending[n:]
+        # the shared buffer is reused by the next read of any relay
+        if pending and self.shared:
+            pending, self.shared = memoryview(pending.tobytes()), False
+        self.pending = pending or None
+        return not pending
+
+def _pipe_size(fd, size=1024 * 1024):
+    # grow the pipe so that a splice moves more than the default 64K
+    try:
+        return fcntl.fcntl(fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+    except (AttributeError, IOError, OSError):
+        return 64 * 1024
+
+class _SpliceLink(_Link):
+    def __init__(self, relay, src, dst, head):
+        _Link.__init__(self, relay, src, dst, head)
+        self.pipe_r, self.pipe_w = os.pipe()
+        self.size = _pipe_size(self.pipe_w)
+        self.in_pipe = 0
+
+    def fill(self):
+        n = _splice(self.src_fd, self.pipe_w, self.size, flags=_SPLICE_FLAGS)
+        self.in_pipe += n
+        return n
+
+    def flush(self):
+        while self.in_pipe:
+            try:
+                n = _splice(self.pipe_r, self.dst_fd, self.in_pipe,
+                            flags=_SPLICE_FLAGS)
+            except OSError as e:
+                if e.args[0] not in _AGAIN:
+                    raise
+                return False
+            metrics.STREAM_SENT.inc(n)
+            self.in_pipe -= n
+        return True
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
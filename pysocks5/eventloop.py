@@ -1,51 +1,360 @@
 # -*- coding: utf-8 -*-
 
+import errno
+import heapq
 import select
 import time
 
 EV_READ, EV_WRITE, EV_ERROR, EV_TIMEOUT, EV_STOP = range(5)
 
-class EventLoop:
+# interest / readiness bits used between `EventLoop` and the pollers,
+# bit `1 << ev` stands for `ev` in (EV_READ, EV_WRITE, EV_ERROR)
+_READ, _WRITE, _ERROR = 1 << EV_READ, 1 << EV_WRITE, 1 << EV_ERROR
+
+def _interrupted(e):
+    # python2 raises select.error/IOError on EINTR, python3.5+ retries itself
+    code = getattr(e, 'errno', None) or (e.args and e.args[0])
+    return code == errno.EINTR
+
+# Pollers share a tiny interface:
+#   register(fd, mask) / modify(fd, mask) / unregister(fd)
+#   poll(timeout) -> [(fd, mask), ...], timeout in seconds or None
+# `mask` is an or-ed combination of _READ, _WRITE and _ERROR. Hang-ups and
+# socket errors are reported as readable/writable, just like `select` does,
+# so that the following `recv`/`send` surfaces the real error.
+
+class SelectPoller(object):
     def __init__(self):
+        self.rwx = [set(), set(), set()]
+
+    def register(self, fd, mask):
+        for ev, fds in enumerate(self.rwx):
+            if mask & (1 << ev):
+                fds.add(fd)
+            else:
+                fds.discard(fd)
+
+    modify = register
+
+    def unregister(self, fd):
+        [fds.discard(fd) for fds in self.rwx]
+
+    def poll(self, timeout):
+        try:
+            rwx = select.select(*(self.rwx + [timeout]))
+        except (select.error, IOError, OSError) as e:
+            if _interrupted(e):
+                return []
+            raise
+        events = {}
+        for ev, fds in enumerate(rwx):
+            for fd in fds:
+                events[fd] = events.get(fd, 0) | (1 << ev)
+        return events.items()
+
+    def close(self):
+        pass
+
+class _FlagPoller(object):
+    # common part of `epoll` and `poll`, which only differ in flag names
+    # and timeout units
+    def __init__(self, impl, IN, OUT, PRI, ERR, HUP):
+        self.impl = impl
+        self.IN, self.OUT, self.PRI = IN, OUT, PRI
+        self.in_flags = IN | ERR | HUP
+        self.out_flags = OUT | ERR | HUP
+        self.err_flags = PRI | ERR | HUP
+
+    def _flags(self, mask):
+        return (mask & _READ and self.IN) | (mask & _WRITE and self.OUT) | \
+               (mask & _ERROR and self.PRI)
+
+    # a closed fd silently leaves epoll, so its number may come back
+    # registered (EEXIST) or unknown (ENOENT) -- fall back to the other call
+    def register(self, fd, mask):
+        try:
+            self.impl.register(fd, self._flags(mask))
+        except (IOError, OSError) as e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.impl.modify(fd, self._flags(mask))
+
+    def modify(self, fd, mask):
+        try:
+            self.impl.modify(fd, self._flags(mask))
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.impl.register(fd, self._flags(mask))
+
+    def unregister(self, fd):
+        try:
+            self.impl.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+    def _poll(self, timeout):
+        raise NotImplementedError
+
+    def poll(self, timeout):
+        try:
+            ready = self._poll(timeout)
+        except (select.error, IOError, OSError) as e:
+            if _interrupted(e):
+                return []
+            raise
+        return [(fd, (flags & self.in_flags and _READ) |
+                     (flags & self.out_flags and _WRITE) |
+                     (flags & self.err_flags and _ERROR))
+                for fd, flags in ready]
+
+class EpollPoller(_FlagPoller):
+    # level-triggered: callbacks may leave data in the kernel buffer and
+    # will be woken up again on the next iteration
+    def __init__(self):
+        _FlagPoller.__init__(self, select.epoll(), select.EPOLLIN,
+                             select.EPOLLOUT, select.EPOLLPRI,
+                             select.EPOLLERR, select.EPOLLHUP)
+
+    def _poll(self, timeout):
+        return self.impl.poll(-1 if timeout is None else timeout)
+
+    def close(self):
+        self.impl.close()
+
+class PollPoller(_FlagPoller):
+    def __init__(self):
+        _FlagPoller.__init__(self, select.poll(), select.POLLIN,
+                             select.POLLOUT, select.POLLPRI,
+                             select.POLLERR,
+                             select.POLLHUP | select.POLLNVAL)
+
+    def _poll(self, timeout):
+        return self.impl.poll(None if timeout is None else timeout * 1000)
+
+    def close(self):
+        pass
+
+class KqueuePoller(object):
+    def __init__(self):
+        self.kq = select.kqueue()
+        self.fds = {}
+
+    def _control(self, fd, filt, flags):
+        try:
+            self.kq.control([select.kevent(fd, filt, flags)], 0)
+        except (IOError, OSError):
+            pass
+
+    def register(self, fd, mask):
+        old = self.fds.get(fd, 0)
+        self.fds[fd] = mask
+        # kqueue has no OOB filter, EV_ERROR is delivered via EV_EOF on read
+        old_r, new_r = bool(old & (_READ | _ERROR)), bool(mask & (_READ | _ERROR))
+        old_w, new_w = bool(old & _WRITE), bool(mask & _WRITE)
+        if old_r != new_r:
+            self._control(fd, select.KQ_FILTER_READ,
+                          new_r and select.KQ_EV_ADD or select.KQ_EV_DELETE)
+        if old_w != new_w:
+            self._control(fd, select.KQ_FILTER_WRITE,
+                          new_w and select.KQ_EV_ADD or select.KQ_EV_DELETE)
+
+    modify = register
+
+    def unregister(self, fd):
+        self.register(fd, 0)
+        del self.fds[fd]
+
+    def poll(self, timeout):
+        try:
+            kevents = self.kq.control(None, max(len(self.fds), 1) * 2, timeout)
+        except (IOError, OSError) as e:
+            if _interrupted(e):
+                return []
+            raise
+        events = {}
+        for kev in kevents:
+            mask = kev.filter == select.KQ_FILTER_WRITE and _WRITE or _READ
+            if kev.flags & (select.KQ_EV_EOF | select.KQ_EV_ERROR):
+                mask |= _READ | _WRITE | _ERROR
+            events[kev.ident] = events.get(kev.ident, 0) | mask
+        return events.items()
+
+    def close(self):
+        self.kq.close()
+
+_pollers = {'epoll': EpollPoller, 'kqueue': KqueuePoller,
+            'poll': PollPoller, 'select': SelectPoller}
+
+# `name` picks one of the pollers above, by default the best one available
+def DefaultPoller(name=None):
+    if name:
+        return _pollers[name]()
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'kqueue'):
+        return KqueuePoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
+# monotonic when available, deadlines must not jump with the wall clock
+_time = getattr(time, 'monotonic', time.time)
+
+class Timer(object):
+    """Handle returned by `EventLoop.call_later`, `cancel()` is O(1)."""
+
+    __slots__ = 'loop', 'deadline', 'callback', 'args'
+
+    def __init__(self, loop, deadline, callback, args):
+        self.loop, self.deadline = loop, deadline
+        self.callback, self.args = callback, args
+
+    def cancel(self):
+        if self.loop is not None:
+            self.loop._cancel(self)
+
+    @property
+    def active(self):
+        return self.loop is not None
+
+class EventLoop:
+    def __init__(self, poller=None):
         self.callbacks = [{} for i in range(5)]
         self.rwx_callbacks = self.callbacks[:3]
         self.timeout_callbacks = self.callbacks[EV_TIMEOUT]
         self.stop_callbacks = self.callbacks[EV_STOP]
+        self.poller = poller or DefaultPoller()
+        self.masks = {}
+        # min-heap of (deadline, seq, timer), cancelled timers are left in
+        # place and skipped (or compacted away when they pile up)
+        self.timers = []
+        self.seq = 0
+        self.cancelled = 0
+        self.now = _time()
+        # called with the seconds spent running callbacks after each
+        # iteration, None skips the timing altogether
+        self.on_iteration = None
+        # when set, callbacks are run through `profiler.call(callback, *args)`
+        self.profiler = None
 
     def run(self):
         self.running = True
-        while self.running and any(self.callbacks):
-            if any(self.rwx_callbacks):
-                rwx = select.select(*self.rwx_callbacks)
+        while self.running and (self.masks or len(self.timers) > self.cancelled):
+            timeout = self._next_timeout()
+            events = ()
+            if self.masks or timeout:
+                events = self.poller.poll(timeout)
+            on_iteration, profiler = self.on_iteration, self.profiler
+            start = on_iteration and _time()
+            for fd, mask in events:
                 for ev, d in enumerate(self.rwx_callbacks):
-                    for fd in rwx[ev]:
-                        if fd in d:
+                    if mask & (1 << ev) and fd in d:
+                        if profiler is None:
                             d[fd]()
-            for fd, value in self.timeout_callbacks.items():
-                callback, t = value
-                if time.time() >= t:
-                    callback()
-                    del self.timeout_callbacks[fd]
+                        else:
+                            profiler.call(d[fd])
+            self._run_timers()
+            if on_iteration:
+                on_iteration(_time() - start)
         else:
-            for callback in self.stop_callbacks.values():
+            for callback in list(self.stop_callbacks.values()):
                 callback()
-    
+
     def stop(self):
         self.running = False
 
+    def call_at(self, deadline, callback, *args):
+        self.seq += 1
+        timer = Timer(self, deadline, callback, args)
+        heapq.heappush(self.timers, (deadline, self.seq, timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(_time() + max(delay, 0), callback, *args)
+
+    def _cancel(self, timer):
+        timer.loop = timer.callback = timer.args = None
+        self.cancelled += 1
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.timers):
+            # in place, `_run_timers` may be iterating over the list
+            self.timers[:] = [t for t in self.timers if t[2].loop is not None]
+            heapq.heapify(self.timers)
+            self.cancelled = 0
+
+    def _next_timeout(self):
+        timers = self.timers
+        while timers and timers[0][2].loop is None:
+            heapq.heappop(timers)
+            self.cancelled -= 1
+        if not timers:
+            return None
+        return max(timers[0][0] - _time(), 0)
+
+    def _run_timers(self):
+        self.now = now = _time()
+        timers, last_seq = self.timers, self.seq
+        # timers scheduled by the callbacks below wait for the next pass
+        while timers and timers[0][0] <= now and timers[0][1] <= last_seq:
+            timer = heapq.heappop(timers)[2]
+            if timer.loop is None:
+                self.cancelled -= 1
+                continue
+            callback, args = timer.callback, timer.args
+            timer.loop = timer.callback = timer.args = None
+            if self.profiler is None:
+                callback(*args)
+            else:
+                self.profiler.call(callback, *args)
+
+    def _fire(self, fd, callback):
+        del self.timeout_callbacks[fd]
+        callback()
+
+    def _update(self, fd):
+        old = self.masks.get(fd, 0)
+        new = 0
+        for ev, d in enumerate(self.rwx_callbacks):
+            if fd in d:
+                new |= 1 << ev
+        if new == old:
+            return
+        if not new:
+            del self.masks[fd]
+            self.poller.unregister(fd)
+        elif not old:
+            self.masks[fd] = new
+            self.poller.register(fd, new)
+        else:
+            self.masks[fd] = new
+            self.poller.modify(fd, new)
+
     # It is expected that no exception will be throwed in `callback`
+    # `EV_TIMEOUT` keeps at most one timer per `fd`, use `call_later` for more
     def register(self, fd, ev, callback, timeout=0):
         if ev != EV_TIMEOUT:
             self.callbacks[ev][fd] = callback
+            if ev < EV_TIMEOUT:
+                self._update(fd)
         else:
-            self.callbacks[ev][fd] = callback, timeout+time.time()
+            self.unregister(fd, EV_TIMEOUT)
+            self.callbacks[ev][fd] = \
+                self.call_later(timeout, self._fire, fd, callback)
 
     def unregister(self, fd, ev):
-        self.callbacks[ev].pop(fd, None)
-    
+        value = self.callbacks[ev].pop(fd, None)
+        if value is None:
+            return
+        if ev == EV_TIMEOUT:
+            value.cancel()
+        elif ev < EV_TIMEOUT:
+            self._update(fd)
+
     def unregister_all(self, fd):
+        self.unregister(fd, EV_TIMEOUT)
         [d.pop(fd, None) for d in self.callbacks]
-    
+        self._update(fd)
+
     def is_register(self, fd, ev):
         return fd in self.callbacks[ev]
 
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import struct
+
+# The tunnel protocol (version 2) spoken by both ends of rsocks5 and aio.
+# Both ends start with a HELLO frame carrying their version, then exchange
+# frames made of a 9 byte header (type, stream id, payload length as '>BII')
+# and the payload:
+#   HELLO           id 0, payload: version and HELLO_* flags as '>BB'
+#                   (flags 0 if missing, trailing bytes ignored)
+#   OPEN            the proxy end opened stream `id`
+#   DATA            payload bytes of stream `id`
+#   CLOSE           the sender closed stream `id`
+#   WINDOW_UPDATE   payload: credit for stream `id` as '>I'
+#   PING / PONG     id 0, PONG echoes the payload of the PING
+#   ZDATA           payload bytes of stream `id`, compressed, only sent to
+#                   peers with HELLO_ZLIB (see compression.py)
+#   ASSOCIATE       the backdoor end made stream `id` a UDP association,
+#                   only sent to peers with HELLO_UDP (see udprelay.py)
+#   DATAGRAM        a datagram of association `id`, payload: its destination
+#                   (towards the backdoor) or source address as in socks5
+#                   requests, then the datagram
+# Stream ids are allocated by the proxy end, counting up from 1 and skipping
+# the ones in use, so a late frame for a closed stream is simply dropped
+# instead of landing in a new connection that got the same fd.
+#
+# Flow control: every stream may have at most `config.stream_window` bytes
+# in flight towards the other end of the tunnel. The receiving end hands
+# credit back with WINDOW_UPDATE once the bytes have been written to its
+# socket, and a sender that runs out of credit stops reading its own
+# socket. A slow stream therefore stalls only its own source, while the
+# tunnel's write buffer is bounded by the sum of the windows. Windows count
+# the bytes of ZDATA frames once decompressed.
+#
+# Compression: the ZDATA frames of a stream are consecutive chunks of a
+# single zlib stream, each ending with a sync flush. A stream may start
+# with DATA frames (sent before the peer's HELLO came in, or too small to
+# be worth compressing) and may switch from ZDATA to DATA, but never back.
+#
+# Datagrams don't take part in flow control, they are dropped instead of
+# queued when the tunnel is backed up.
+PROTOCOL_VERSION = 2
+
+HELLO, OPEN, DATA, CLOSE, WINDOW_UPDATE, PING, PONG, ZDATA, ASSOCIATE, \
+    DATAGRAM = range(10)
+
+# the sender can decompress ZDATA frames
+HELLO_ZLIB = 0x01
+# the sender relays UDP associations, as the proxy end
+HELLO_UDP = 0x02
+
+HEADER = struct.Struct('>BII')
+
+# the frames whose payload has a fixed size, checked before they are
+# handled: any other size is a protocol error
+PAYLOAD_SIZES = {WINDOW_UPDATE: 4}
+
+# larger frames are taken for garbage rather than buffered
+MAX_FRAME = 16 * 1024 * 1024
@@ -1,7 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import sys, traceback
+import atexit, collections, json, sys, threading, time, traceback
 
 class CodingWrappedWriter:
     def __init__(self, coding, writer):
@@ -17,19 +17,159 @@ if eqaulUtf8(sys.stderr.encoding):
 else:
     utf8Stderr = CodingWrappedWriter('utf8', sys.stderr)
 
+# Writes the lines given to `write` from a background thread, in batches,
+# so that logging never waits for the terminal or a slow pipe. At most
+# `maxLines` lines are kept, the oldest ones are dropped (and counted) if
+# the writer can't keep up. `flush` writes out everything right away.
+class BufferedWriter(object):
+    def __init__(self, writer, maxLines=10000, interval=0.1):
+        self.writer = writer
+        self.interval = interval
+        self.lines = collections.deque(maxlen=maxLines)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def write(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+        # threads don't survive a fork, each process starts its own
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        if len(self.lines) * 2 > self.lines.maxlen:
+            self.wakeup.set()
+
+    def flush(self):
+        with self.lock:
+            batch = []
+            while self.lines:
+                batch.append(self.lines.popleft())
+            if self.dropped:
+                batch.append('[WARN] Logger %d lines dropped\n' % self.dropped)
+                self.dropped = 0
+            if batch:
+                self.writer.write(''.join(batch))
+                self.writer.flush()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except (IOError, OSError, ValueError):
+                pass
+
+# Lets through `rate` messages per second (in bursts of as many) for each
+# logger class, level and leading message word. `check` returns None for
+# a message to drop, else how many were dropped since the last one passed.
+class RateLimiter(object):
+
+    maxKeys = 4096
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.buckets = {}   # key -> [tokens, last update, suppressed]
+
+    def check(self, slf, level, message):
+        first = message[0] if message and isinstance(message[0], str) \
+                else None
+        key = slf.__class__, level, first
+        now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.maxKeys:
+                self.buckets.clear()
+            bucket = self.buckets[key] = [self.rate, now, 0]
+        tokens = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            return None
+        bucket[0] = tokens - 1
+        suppressed, bucket[2] = bucket[2], 0
+        return suppressed
+
+# payloads are dumped up to `dumpLimit` bytes, memoryviews of socket
+# buffers as the bytes they refer to
+dumpLimit = 256
+
+def _dumpRepr(obj):
+    if isinstance(obj, memoryview):
+        obj = obj[:dumpLimit + 1].tobytes()
+    elif isinstance(obj, bytearray):
+        obj = bytes(obj[:dumpLimit + 1])
+    if isinstance(obj, bytes) and len(obj) > dumpLimit:
+        return repr(obj[:dumpLimit]) + '...'
+    return repr(obj)
+
+def _formatText(level, name, message, fields, tb):
+    line = '[%s] %s ' % (level[:4], name)
+    if tb:
+        line += '\n' + tb
+    line += message
+    for key in sorted(fields):
+        line += ' %s=%s' % (key, fields[key])
+    return line + '\n'
+
+def _formatJson(level, name, message, fields, tb):
+    record = dict(fields)
+    if not isinstance(message, type(u'')):
+        message = message.decode('utf-8', 'replace')
+    record.update(time=round(time.time(), 6), level=level.lower(),
+                  name=name, message=message)
+    if tb:
+        record['traceback'] = tb
+    return json.dumps(record, sort_keys=True, default=repr) + '\n'
+
+_formatters = {'text': _formatText, 'json': _formatJson}
+_format = _formatText
+_limiter = None
+
 levels = 'NULL', 'NOTIFY', 'CRITICAL', 'ERROR', 'WARN', 'INFO', 'DEBUG', 'DUMP'
     
-def _log(slf, level, *message, **kwargs):
-    slf.writer.write('[%s] %s ' % (level[:4], slf.name))
-    if kwargs.get('exc_info', False):
-        slf.writer.write('\n')
-        traceback.print_exc(file=slf.writer)
+# keyword arguments other than `exc_info` are structured fields, appended
+# as key=value in text and as keys of the record in json
+def _log(slf, level, *message, **fields):
+    tb = fields.pop('exc_info', False) and traceback.format_exc()
+    if _limiter is not None and level != 'NOTIFY':
+        suppressed = _limiter.check(slf, level, message)
+        if suppressed is None:
+            return
+        if suppressed:
+            fields['suppressed'] = suppressed
     if level == 'DUMP':
-        s = ' '.join(map(repr, message))
+        s = ' '.join(map(_dumpRepr, message))
     else:        
         s = ' '.join(map(str, message))
-    slf.writer.write(s)
-    slf.writer.write('\n')
+    slf.writer.write(_format(level, slf.name, s, fields, tb))
+
+def setupLogging(format='text', rate=0, buffered=False, bufferLines=10000):
+    """Selects the line format ('text' or 'json'), limits each kind of
+    message to `rate` per second (0 for no limit) and with `buffered`
+    hands the lines to a background thread instead of writing them out
+    on the spot"""
+    global _format, _limiter
+    _format = _formatters[format]
+    _limiter = RateLimiter(rate) if rate else None
+    flushLogs()
+    if buffered:
+        Logger.writer = BufferedWriter(utf8Stderr, bufferLines)
+    else:
+        Logger.writer = utf8Stderr
+
+def flushLogs():
+    try:
+        Logger.writer.flush()
+    except (IOError, OSError, ValueError):
+        pass    # e.g. stderr already closed at exit
+
+atexit.register(flushLogs)
 
 def _logUnboundedMethod(level):
     return lambda slf, *msg, **kwargs: _log(slf, level, *msg, **kwargs)
@@ -83,8 +223,9 @@ class _LoggerMetaClass(type):
 
         return type.__new__(cls, name, bases, attrs)
 
-class Logger(object):
-    __metaclass__ = _LoggerMetaClass
+# the metaclass comes in through a base class, python 2 and 3 don't agree
+# on how to declare it
+class Logger(_LoggerMetaClass('_LoggerBase', (object,), {})):
 
     def setLevel(self, level):
         level = level.upper()
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+
+from eventloop import Loop
+from sockserver import AsynSocket, Server
+from frames import HELLO, OPEN, DATA, CLOSE, WINDOW_UPDATE, PING, PONG, \
+                   ZDATA, ASSOCIATE, DATAGRAM
+
+import config
+
+# Per-process metrics, cheap enough to be updated for every frame: counting
+# is an attribute increment, observing a histogram a bisect over its bucket
+# bounds. A gauge may instead be given a function that is only called when
+# the metrics are scraped. `render` gives them all in the prometheus text
+# format, which `MetricsServer` serves over http from the process' own loop.
+#
+# Metrics are identified by name plus a fixed set of labels, one object
+# per combination, so the hot paths never build label keys.
+
+class Registry(object):
+    def __init__(self):
+        self.names = []
+        self.series = {}    # name -> [metric, ...] with that name
+
+    def add(self, metric):
+        if metric.name not in self.series:
+            self.names.append(metric.name)
+            self.series[metric.name] = []
+        self.series[metric.name].append(metric)
+
+    def render(self):
+        lines = []
+        for name in self.names:
+            series = self.series[name]
+            lines.append('# HELP %s %s' % (name, series[0].help))
+            lines.append('# TYPE %s %s' % (name, series[0].type))
+            for metric in series:
+                lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def render():
+    return REGISTRY.render()
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % pair for pair in pairs)
+
+def _format_value(value):
+    if not isinstance(value, float):
+        return str(value)
+    return '+Inf' if value == float('inf') else repr(value)
+
+class Metric(object):
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=None, registry=REGISTRY):
+        self.name, self.help = name, help
+        self.labels = sorted((labels or {}).items())
+        registry.add(self)
+
+    def samples(self):
+        raise NotImplementedError
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=None, registry=REGISTRY):
+        Metric.__init__(self, name, help, labels, registry)
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.labels),
+                             _format_value(self.value))]
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=None, registry=REGISTRY):
+        Metric.__init__(self, name, help, labels, registry)
+        self.value = 0
+        self.func = None
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+    # read the value from `func()` at scrape time instead
+    def set_function(self, func):
+        self.func = func
+
+    def samples(self):
+        value = self.func() if self.func is not None else self.value
+        return ['%s%s %s' % (self.name, _format_labels(self.labels),
+                             _format_value(value))]
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=None, registry=REGISTRY):
+        Metric.__init__(self, name, help, labels, registry)
+        self.bounds = sorted(buckets)
+        # counts[i] is for values in (bounds[i-1], bounds[i]], the last one
+        # for those above all bounds
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        lines, total = [], 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            total += count
+            labels = self.labels + [('le', _format_value(float(bound)))]
+            lines.append('%s_bucket%s %d' %
+                         (self.name, _format_labels(labels), total))
+        labels = _format_labels(self.labels)
+        lines.append('%s_sum%s %s' % (self.name, labels,
+                                      _format_value(self.sum)))
+        lines.append('%s_count%s %d' % (self.name, labels, self.count))
+        return lines
+
+# The metrics of pysocks5 itself. "Streams" are the proxied connections,
+# their sockets face the clients on the proxy side and the requested hosts
+# on the backdoor side (both in direct mode).
+
+STREAMS = Gauge('pysocks5_streams', 'Streams currently open')
+STREAMS_OPENED = Counter('pysocks5_streams_opened_total', 'Streams opened')
+
+STREAM_RECEIVED = Counter('pysocks5_stream_received_bytes_total',
+                          'Bytes read from stream sockets')
+STREAM_SENT = Counter('pysocks5_stream_sent_bytes_total',
+                      'Bytes written to stream sockets')
+
+HANDSHAKE_FAILURES = dict(
+    (reason, Counter('pysocks5_handshake_failures_total',
+                     'Socks5 handshakes that failed, by reason',
+                     {'reason': reason}))
+    for reason in ('method', 'request', 'resolve', 'connect', 'timeout'))
+
+TUNNELS = Gauge('pysocks5_tunnels', 'Tunnels currently connected')
+TUNNEL_RECEIVED = Counter('pysocks5_tunnel_received_bytes_total',
+                          'Bytes read from tunnels')
+TUNNEL_SENT = Counter('pysocks5_tunnel_sent_bytes_total',
+                      'Bytes written to tunnels')
+TUNNEL_WRITE_BUFFER = Gauge('pysocks5_tunnel_write_buffer_bytes',
+                            'Bytes queued for sending on the tunnels')
+TUNNEL_SENDS = Counter('pysocks5_tunnel_sends_total',
+                       'Successful send calls on tunnels')
+TUNNEL_WRITE_PAUSES = Counter(
+    'pysocks5_tunnel_write_pauses_total',
+    'Times a tunnel write buffer went above its high watermark')
+
+_frame_types = [(HELLO, 'hello'), (OPEN, 'open'), (DATA, 'data'),
+                (CLOSE, 'close'), (WINDOW_UPDATE, 'window_update'),
+                (PING, 'ping'), (PONG, 'pong'), (ZDATA, 'zdata'),
+                (ASSOCIATE, 'associate'), (DATAGRAM, 'datagram')]
+
+def _frame_counters(direction):
+    # indexed by frame type
+    counters = [None] * len(_frame_types)
+    for _type, name in _frame_types:
+        counters[_type] = Counter('pysocks5_frames_%s_total' % direction,
+                                  'Tunnel frames %s, by type' % direction,
+                                  {'type': name})
+    return counters
+
+FRAMES_RECEIVED = _frame_counters('received')
+FRAMES_SENT = _frame_counters('sent')
+
+COMPRESS_IN = Counter('pysocks5_compress_in_bytes_total',
+                      'Stream bytes compressed for the tunnels')
+COMPRESS_OUT = Counter('pysocks5_compress_out_bytes_total',
+                       'Bytes the compressed stream bytes came down to')
+COMPRESS_SECONDS = Counter('pysocks5_compress_seconds_total',
+                           'Time spent compressing stream bytes')
+COMPRESS_GIVEN_UP = Counter(
+    'pysocks5_compress_given_up_total',
+    'Streams found incompressible, sent uncompressed from then on')
+
+ASSOCIATIONS = Gauge('pysocks5_udp_associations',
+                     'UDP associations currently open')
+DATAGRAMS_RELAYED = dict(
+    (direction, Counter('pysocks5_datagrams_relayed_total',
+                        'Datagrams relayed, by direction',
+                        {'direction': direction}))
+    for direction in ('up', 'down'))
+DATAGRAMS_DROPPED = dict(
+    (reason, Counter('pysocks5_datagrams_dropped_total',
+                     'Datagrams dropped, by reason', {'reason': reason}))
+    for reason in ('filtered', 'malformed', 'resolve', 'send', 'backlog',
+                   'peers'))
+
+WARM_HITS = Counter('pysocks5_warm_hits_total',
+                    'Upstream connections taken from the warm pool')
+WARM_MISSES = Counter('pysocks5_warm_misses_total',
+                      'Upstream connections the warm pool had none ready for')
+
+LOOP_ITERATION = Histogram(
+    'pysocks5_loop_iteration_seconds',
+    'Time spent running callbacks per event loop iteration',
+    [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1])
+
+# In prefork mode worker `i` serves its metrics on `metrics_port` + i.
+# Loop iterations are only timed while the metrics are served. Returns the
+# started server, to be drained along with the others, or None.
+def start_metrics(worker_id=0, event_loop=Loop):
+    if not config.metrics_port:
+        return None
+    addr = config.metrics_ip, config.metrics_port + worker_id
+    server = MetricsServer(addr)
+    if not server.Start(event_loop):
+        return None
+    event_loop.on_iteration = LOOP_ITERATION.observe
+    return server
+
+class MetricsServer(Server):
+    def handle(self, client_sock, client_addr, event_loop, server_obj):
+        MetricsHandler(client_sock, client_addr, event_loop)
+
+    # the metrics are not worth taking the process down
+    def on_failed_to_start(self, e):
+        self.warn('metrics unavailable:', e)
+
+# answers a single `GET /metrics` per connection
+class MetricsHandler(AsynSocket):
+
+    level = config.log_level
+
+    idle_timeout = 10
+    max_request = 8192
+
+    def on_data(self, data, all_data):
+        head = all_data.tobytes()
+        if b'\r\n\r\n' not in head and b'\n\n' not in head:
+            if len(head) > self.max_request:
+                self.Abort()
+                return
+            return all_data
+        request = head.split(b'\n', 1)[0].split()
+        if len(request) >= 2 and request[0] == b'GET' and \
+                request[1].split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            status, body = '404 Not Found', b'not found\n'
+            content_type = 'text/plain'
+        head = 'HTTP/1.0 %s\r\n' \
+               'Content-Type: %s\r\n' \
+               'Content-Length: %d\r\n' \
+               'Connection: close\r\n\r\n' % \
+               (status, content_type, len(body))
+        self.Send(head.encode('ascii'))
+        self.Send(body)
+        self.Close()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+
+from logger import Logger, flushLogs
+
+# Prefork mode: the supervisor forks `num_workers` processes, each running
+# `target(worker_id)` with its own `EventLoop`, restarts the ones that die,
+# and on SIGTERM/SIGINT asks them to drain (SIGTERM) before killing the
+# stragglers after `drain_timeout` seconds.
+
+def OnTerminate(event_loop, callback):
+    """Run `callback` from `event_loop` when the process receives SIGTERM"""
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: event_loop.call_later(0, callback))
+
+class Supervisor(Logger):
+
+    level = 'info'
+
+    # a worker dying sooner than `min_uptime` after its start is restarted
+    # with an exponential delay, capped at `max_restart_delay`
+    min_uptime = 1
+    max_restart_delay = 30
+
+    def __init__(self, target, num_workers=None, drain_timeout=30):
+        self.target = target
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.drain_timeout = drain_timeout
+        self.workers = {}       # pid -> (worker_id, start time)
+        self.restarts = {}      # worker_id -> due time
+        self.delays = {}        # worker_id -> last restart delay
+        self.stopping = False
+
+    def Run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        self.notify('starting', self.num_workers, 'workers')
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+
+        while self.workers or (self.restarts and not self.stopping):
+            self._reap()
+            now = time.time()
+            if self.stopping and now > self.deadline:
+                self.warn('drain timeout, killing', len(self.workers),
+                          'workers')
+                self._kill(signal.SIGKILL)
+                self.deadline = float('inf')
+            for worker_id, due in list(self.restarts.items()):
+                if not self.stopping and now >= due:
+                    self._spawn(worker_id)
+            time.sleep(0.1)
+
+        self.notify('stopped')
+
+    def _on_signal(self, signum, frame):
+        if not self.stopping:
+            self.notify('draining workers')
+            self.stopping = True
+            self.deadline = time.time() + self.drain_timeout
+            self._kill(signal.SIGTERM)
+
+    def _kill(self, signum):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self.workers.clear()
+                return
+            if pid == 0:
+                return
+            if pid not in self.workers:
+                continue
+            worker_id, started = self.workers.pop(pid)
+            if self.stopping:
+                self.info('worker', worker_id, 'exited')
+                continue
+            if os.WIFSIGNALED(status):
+                self.error('worker', worker_id, 'killed by signal',
+                           os.WTERMSIG(status))
+            elif os.WEXITSTATUS(status):
+                self.error('worker', worker_id, 'died with exit code',
+                           os.WEXITSTATUS(status))
+            else:
+                self.info('worker', worker_id, 'exited, restarting')
+            delay = 0
+            if time.time() - started < self.min_uptime:
+                delay = max(self.delays.get(worker_id, 0) * 2, 0.5)
+                delay = min(delay, self.max_restart_delay)
+            self.delays[worker_id] = delay
+            self.restarts[worker_id] = time.time() + delay
+
+    def _spawn(self, worker_id):
+        self.restarts.pop(worker_id, None)
+        # or the child would write the lines still buffered once more
+        flushLogs()
+        pid = os.fork()
+        if pid:
+            self.info('worker', worker_id, 'started, pid', pid)
+            self.workers[pid] = worker_id, time.time()
+            return
+
+        # child: the supervisor coordinates shutdown, ctrl-c only reaches
+        # the workers through it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 0
+        try:
+            self.target(worker_id)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            traceback.print_exc(file=sys.stderr)
+            code = 1
+        flushLogs()
+        sys.stderr.flush()
+        os._exit(code)
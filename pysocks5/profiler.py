@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import os
+import signal
+import time
+import traceback
+
+from eventloop import Loop, EV_STOP
+from logger import Logger
+
+import config
+import metrics
+
+# Opt-in profiling of an `EventLoop`: once installed as its `profiler`,
+# every callback the loop dispatches goes through `LoopProfiler.call`,
+# which times it into a histogram per socket class and callback (exported
+# with the other metrics) and logs the ones running longer than
+# `slow_callback` along with the stack they were stuck in, caught by a
+# SIGALRM watchdog. Optionally a SIGPROF timer samples the stack every
+# `sample_interval` seconds of CPU time, the samples are written in the
+# collapsed format of flamegraph.pl (and speedscope) when the loop stops
+# and on SIGUSR2.
+
+_time = getattr(time, 'monotonic', time.time)
+
+_CALLBACK_BUCKETS = [0.00001, 0.0001, 0.001, 0.01, 0.1, 1]
+
+def start_profiler(worker_id=0, event_loop=Loop):
+    if not config.profile:
+        return None
+    path = config.profile_samples
+    if path and config.workers > 1:
+        path += '.%d' % worker_id
+    return LoopProfiler(event_loop, config.slow_callback, path)
+
+def _describe(callback):
+    """Returns (class or module name, callback name, socket name or None)"""
+    owner = getattr(callback, '__self__', None)
+    func = getattr(callback, '__func__', callback)
+    name = getattr(func, '__name__', type(func).__name__)
+    if name == '<lambda>':
+        name += ':%d' % func.__code__.co_firstlineno
+    if owner is None:
+        return getattr(func, '__module__', None) or '?', name, None
+    return type(owner).__name__, name, getattr(owner, 'name', None)
+
+def _collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+class LoopProfiler(Logger):
+
+    level = 'warn'
+
+    sample_interval = 0.005
+
+    def __init__(self, event_loop, slow=0.1, samples_path=None):
+        self.name = 'LoopProfiler'
+        self.event_loop = event_loop
+        self.slow = slow
+        self.histograms = {}    # (code, owner class) -> Histogram
+        self.stalled = None     # stack caught by the watchdog
+        self.samples = collections.Counter()
+        self.samples_file = None
+        event_loop.profiler = self
+        if slow and hasattr(signal, 'setitimer'):
+            signal.signal(signal.SIGALRM, self._on_alarm)
+            signal.siginterrupt(signal.SIGALRM, False)
+        else:
+            self.slow = 0
+        if samples_path:
+            # opened right away so that a bad path shows up at startup
+            self.samples_file = open(samples_path, 'w')
+            event_loop.register(self.samples_file.fileno(), EV_STOP,
+                                self.Dump)
+            signal.signal(signal.SIGUSR2, lambda signum, frame:
+                          event_loop.call_later(0, self.Dump))
+            signal.signal(signal.SIGPROF, self._on_sample)
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.sample_interval,
+                             self.sample_interval)
+        self.notify('profiling, slow callbacks take %gs' % slow)
+
+    def call(self, callback, *args):
+        if self.slow:
+            self.stalled = None
+            signal.setitimer(signal.ITIMER_REAL, self.slow)
+        start = _time()
+        try:
+            callback(*args)
+        finally:
+            elapsed = _time() - start
+            if self.slow:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            self._record(callback, elapsed)
+
+    def _record(self, callback, elapsed):
+        # keyed by code object, lambdas are new functions every time
+        func = getattr(callback, '__func__', callback)
+        key = getattr(func, '__code__', func), \
+              type(getattr(callback, '__self__', None))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            cls, name = _describe(callback)[:2]
+            histogram = self.histograms[key] = metrics.Histogram(
+                'pysocks5_callback_seconds',
+                'Time spent in event loop callbacks, by class and callback',
+                _CALLBACK_BUCKETS, {'class': cls, 'callback': name})
+        histogram.observe(elapsed)
+        if self.slow and elapsed >= self.slow:
+            cls, name, socket_name = _describe(callback)
+            self.warn('slow callback %s.%s of %s took %.3fs' %
+                      (cls, name, socket_name or '-', elapsed),
+                      '\n' + ''.join(self.stalled or []))
+
+    def _on_alarm(self, signum, frame):
+        self.stalled = traceback.format_stack(frame)
+
+    def _on_sample(self, signum, frame):
+        self.samples[_collapse(frame)] += 1
+
+    # rewrites the samples file with all samples taken so far
+    def Dump(self):
+        if self.samples_file is None:
+            return
+        f = self.samples_file
+        f.seek(0)
+        f.truncate()
+        for stack, count in sorted(self.samples.items()):
+            f.write('%s %d\n' % (stack, count))
+        f.flush()
+        self.notify('wrote', len(self.samples), 'stacks to', f.name)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import errno
+import random
+import socket
+import struct
+
+from eventloop import Loop, EV_READ
+from logger import Logger
+from sockserver import Family
+
+# A small stub resolver talking plain DNS over UDP, driven by an `EventLoop`
+# so that a slow lookup never blocks the loop. Answers are cached (LRU,
+# bounded by their TTL) and concurrent lookups for the same name share one
+# query. Nameservers default to the ones in /etc/resolv.conf and can be any
+# IPv4 or IPv6 (ip, port), e.g. a local stub server in tests.
+#
+# With `ipv6`, A and AAAA queries go out together. Once one of them has
+# brought addresses the other gets `resolution_delay` more seconds, and
+# the addresses are then interleaved IPv6 first as RFC 8305 recommends, for
+# `Connector` to race.
+#
+# Every query goes out from a socket of its own, so from a fresh ephemeral
+# port, with an id from the system's CSPRNG, and only an answer to that id
+# and name from one of the nameservers is taken: an off-path attacker has
+# to guess both the port and the id to get a forged answer in. A retry to
+# a nameserver of the other address family gets a new socket of that
+# family.
+
+QTYPE_A, QTYPE_AAAA, QCLASS_IN = 1, 28, 1
+RCODE_NXDOMAIN = 3
+
+_random = random.SystemRandom()
+
+def read_resolv_conf(path='/etc/resolv.conf'):
+    servers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                # link-local IPv6 ones come with a %scope
+                if len(fields) >= 2 and fields[0] == 'nameserver' and \
+                        is_ip(fields[1].split('%')[0]):
+                    servers.append((fields[1], 53))
+    except IOError:
+        pass
+    return servers or [('127.0.0.1', 53)]
+
+def read_hosts(path='/etc/hosts'):
+    hosts = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split('#', 1)[0].split()
+                if len(fields) >= 2 and is_ip(fields[0]):
+                    for name in fields[1:]:
+                        hosts.setdefault(name.lower(), []).append(fields[0])
+    except IOError:
+        pass
+    return hosts
+
+def is_ipv4(host):
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+    except (socket.error, ValueError, TypeError):
+        return False
+    return True
+
+def is_ipv6(host):
+    try:
+        socket.inet_pton(socket.AF_INET6, host)
+    except (socket.error, ValueError, TypeError):
+        return False
+    return True
+
+def is_ip(host):
+    return is_ipv4(host) or is_ipv6(host)
+
+def _nameserver(server):
+    # an (ip, port) tuple, also from a list, with an IPv6 ip written the
+    # way recvfrom() reports it so that its answers are recognised
+    ip, port = server
+    if is_ipv6(ip):
+        ip = socket.inet_ntop(socket.AF_INET6,
+                              socket.inet_pton(socket.AF_INET6, ip))
+    return ip, int(port)
+
+def interleave(first, second):
+    """[a1, b1, a2, b2, ...], whatever is left of the longer list last"""
+    addrs = []
+    for i in range(max(len(first), len(second))):
+        addrs.extend(first[i:i+1])
+        addrs.extend(second[i:i+1])
+    return addrs
+
+def build_query(qid, name, qtype=QTYPE_A):
+    # header: id, flags (RD), qdcount=1, ancount, nscount, arcount
+    query = bytearray(struct.pack('>HHHHHH', qid, 0x0100, 1, 0, 0, 0))
+    for label in name.rstrip('.').split('.'):
+        label = label.encode('idna') if not isinstance(label, bytes) \
+                else label
+        if not 0 < len(label) < 64:
+            raise ValueError('bad domain name %r' % name)
+        query.append(len(label))
+        query += label
+    query += b'\x00' + struct.pack('>HH', qtype, QCLASS_IN)
+    return query
+
+def _skip_name(msg, i):
+    while True:
+        n = msg[i]
+        if n == 0:
+            return i + 1
+        if n & 0xc0 == 0xc0:
+            return i + 2
+        i += n + 1
+
+def _read_name(msg, i):
+    labels, jumps = [], 0
+    while True:
+        n = msg[i]
+        if n == 0:
+            return b'.'.join(labels).lower()
+        if n & 0xc0 == 0xc0:
+            jumps += 1
+            if jumps > 16:
+                raise ValueError('compression loop')
+            i = ((n & 0x3f) << 8) | msg[i+1]
+        else:
+            labels.append(bytes(msg[i+1:i+1+n]))
+            i += n + 1
+
+def parse_response(msg, qtype=QTYPE_A):
+    """Returns (qid, qname, rcode, addrs, ttl) for the A or AAAA `qtype`,
+    raises on malformed input"""
+    msg = bytearray(msg)
+    qid, flags, qdcount, ancount = struct.unpack('>HHHH', bytes(msg[:8]))
+    if not flags & 0x8000 or qdcount != 1:
+        raise ValueError('not a response to a single question')
+    qname = _read_name(msg, 12)
+    i = _skip_name(msg, 12) + 4
+    addrs, ttl = [], None
+    for _ in range(ancount):
+        i = _skip_name(msg, i)
+        rtype, rclass, rttl, rdlen = \
+            struct.unpack('>HHIH', bytes(msg[i:i+10]))
+        i += 10
+        rdata = bytes(msg[i:i+rdlen])
+        i += rdlen
+        if rtype != qtype or rclass != QCLASS_IN:
+            continue
+        if rtype == QTYPE_A and rdlen == 4:
+            addrs.append(socket.inet_ntoa(rdata))
+        elif rtype == QTYPE_AAAA and rdlen == 16:
+            addrs.append(socket.inet_ntop(socket.AF_INET6, rdata))
+        else:
+            continue
+        ttl = rttl if ttl is None else min(ttl, rttl)
+    if i > len(msg):
+        raise ValueError('truncated message')
+    return qid, qname, flags & 0x0f, addrs, ttl or 0
+
+class _Query(object):
+    def __init__(self, qid, name, qtype, packet):
+        self.qid, self.name, self.qtype, self.packet = qid, name, qtype, packet
+        self.sock = None
+        self.tries = 0
+        self.timer = None
+
+# the queries for one name and the callbacks waiting for it
+class _Lookup(object):
+    def __init__(self, name, callback):
+        self.name = name
+        self.callbacks = [callback]
+        self.queries = []       # unanswered
+        self.answers = {}       # qtype -> (addrs, ttl)
+        self.timer = None       # resolution delay
+
+class Resolver(Logger):
+
+    level = 'warn'
+
+    resolution_delay = 0.05
+
+    def __init__(self, event_loop=None, nameservers=None, timeout=2.0,
+                 tries=3, cache_size=1024, max_ttl=3600, negative_ttl=30,
+                 hosts=None, ipv6=True):
+        self.event_loop = event_loop or Loop
+        self.nameservers = [_nameserver(server) for server
+                            in nameservers or read_resolv_conf()]
+        self.timeout, self.tries = timeout, tries
+        self.cache_size, self.max_ttl = cache_size, max_ttl
+        self.negative_ttl = negative_ttl
+        self.hosts = read_hosts() if hosts is None else hosts
+        self.qtypes = (QTYPE_AAAA, QTYPE_A) if ipv6 else (QTYPE_A,)
+        self.cache = collections.OrderedDict()  # name -> (expires, addrs)
+        self.lookups = {}                        # name -> _Lookup
+
+    # `callback(addrs)` gets a list of IP strings, empty on failure. It is
+    # called synchronously for literals, /etc/hosts entries and cache hits.
+    def Resolve(self, host, callback):
+        try:
+            name = host.decode('idna') if isinstance(host, bytes) else host
+        except (UnicodeError, ValueError) as e:
+            self.info('bad domain name', repr(host), e)
+            return callback([])
+        name = name.rstrip('.').lower()
+
+        if is_ip(name):
+            return callback([name])
+        if name in self.hosts:
+            return callback(self.hosts[name])
+
+        entry = self.cache.pop(name, None)
+        if entry is not None:
+            if entry[0] > self.event_loop.now:
+                self.cache[name] = entry
+                return callback(entry[1])
+
+        if name in self.lookups:
+            self.lookups[name].callbacks.append(callback)
+            return
+
+        lookup = _Lookup(name, callback)
+        try:
+            for qtype in self.qtypes:
+                self._query(lookup, qtype)
+        except (ValueError, UnicodeError, socket.error) as e:
+            self.warn('failed to query', repr(name), e)
+            self._cancel_queries(lookup)
+            return callback([])
+        self.lookups[name] = lookup
+
+    def _query(self, lookup, qtype):
+        qid = _random.randint(0, 0xffff)
+        packet = build_query(qid, lookup.name, qtype)
+        query = _Query(qid, lookup.name, qtype, packet)
+        self._open(query, Family(self.nameservers[0]))
+        lookup.queries.append(query)
+        self._send(query)
+
+    # gives `query` a new socket of `family`, in place of its current one
+    def _open(self, query, family):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        if query.sock is not None:
+            self.event_loop.unregister_all(query.sock.fileno())
+            query.sock.close()
+        query.sock = sock
+        self.event_loop.register(sock.fileno(), EV_READ,
+                                 lambda: self._read(query))
+
+    def _close_query(self, query):
+        if query.timer is not None:
+            query.timer.cancel()
+        self.event_loop.unregister_all(query.sock.fileno())
+        query.sock.close()
+        query.sock = None
+
+    def _cancel_queries(self, lookup):
+        for query in lookup.queries:
+            self._close_query(query)
+        lookup.queries = []
+
+    def _send(self, query):
+        server = self.nameservers[query.tries % len(self.nameservers)]
+        query.tries += 1
+        try:
+            if query.sock.family != Family(server):
+                self._open(query, Family(server))
+            query.sock.sendto(query.packet, server)
+        except socket.error as e:
+            self.debug('sendto', server, 'failed:', e)
+        query.timer = \
+            self.event_loop.call_later(self.timeout, self._timeout, query)
+
+    def _timeout(self, query):
+        if query.tries < self.tries * len(self.nameservers):
+            self.debug('retry', query.name)
+            self._send(query)
+        else:
+            self.info('timed out resolving', query.name)
+            self._answer(query, [], 0)
+
+    def _read(self, query):
+        # the query is closed once answered
+        while query.sock is not None:
+            try:
+                msg, addr = query.sock.recvfrom(4096)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.warn('recvfrom failed:', e)
+                return
+            self._on_response(query, msg, addr)
+
+    def _on_response(self, query, msg, addr):
+        try:
+            qid, qname, rcode, addrs, ttl = parse_response(msg, query.qtype)
+        except (ValueError, IndexError, struct.error):
+            self.debug('malformed response from', addr)
+            return
+        if qid != query.qid or qname != query.name.encode('idna') or \
+                addr[:2] not in self.nameservers:
+            self.debug('unexpected response from', addr)
+            return
+        if rcode == RCODE_NXDOMAIN or (rcode == 0 and not addrs):
+            self._answer(query, [], self.negative_ttl)
+        elif rcode == 0:
+            self._answer(query, addrs, ttl)
+        else:
+            self.debug('rcode', rcode, 'for', query.name, 'from', addr)
+            query.timer.cancel()
+            self._timeout(query)    # SERVFAIL & co: try the next server
+
+    def _answer(self, query, addrs, ttl):
+        lookup = self.lookups[query.name]
+        self._close_query(query)
+        lookup.queries.remove(query)
+        lookup.answers[query.qtype] = addrs, ttl
+        if not lookup.queries:
+            self._finish(lookup)
+        elif addrs and lookup.timer is None:
+            lookup.timer = self.event_loop.call_later(
+                self.resolution_delay, self._finish, lookup)
+
+    def _finish(self, lookup):
+        if lookup.timer is not None:
+            lookup.timer.cancel()
+        self._cancel_queries(lookup)
+        del self.lookups[lookup.name]
+
+        answers = lookup.answers
+        addrs = interleave(answers.get(QTYPE_AAAA, ([], 0))[0],
+                           answers.get(QTYPE_A, ([], 0))[0])
+        # a failure is only cached once every query has failed
+        if addrs:
+            ttl = min(t for found, t in answers.values() if found)
+        elif len(answers) == len(self.qtypes):
+            ttl = min(t for found, t in answers.values())
+        else:
+            ttl = 0
+        ttl = min(ttl, self.max_ttl)
+        if ttl > 0:
+            self.cache[lookup.name] = self.event_loop.now + ttl, addrs
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        for callback in lookup.callbacks:
+            callback(addrs)
+
+_resolvers = {}
+
+def GetResolver(event_loop=None, **kwargs):
+    # one shared resolver (and cache) per event loop
+    event_loop = event_loop or Loop
+    if event_loop not in _resolvers:
+        _resolvers[event_loop] = Resolver(event_loop, **kwargs)
+    return _resolvers[event_loop]
@@ -1,196 +1,796 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import os
 import sys
 import struct
 import socket
+import random
+import zlib
 
-from sockserver import AsynSocket, Server, Connect
+from eventloop import EventLoop, Loop, DefaultPoller
+from buffer import Buffer
+from logger import Logger, setupLogging
+from sockserver import AsynSocket, Server, Connect, SetSocketOptions
+from connector import Connector
+from resolver import GetResolver
+from prefork import OnTerminate, Supervisor
+from direct import start_direct
+from warmpool import WarmPool
+from profiler import start_profiler
+from udprelay import ClientRelay, Association, unmap
+from compression import StreamCompressor, decompress
+from frames import PROTOCOL_VERSION, HELLO, OPEN, DATA, CLOSE, \
+                   WINDOW_UPDATE, PING, PONG, ZDATA, ASSOCIATE, DATAGRAM, \
+                   HELLO_ZLIB, HELLO_UDP, HEADER, MAX_FRAME, PAYLOAD_SIZES
 
 import config
+import metrics
+import socks5
 
-def start_proxy():
-    TunnelServer((config.tunnel_ip, config.tunnel_port)).Run()
-    ProxyServer(('0.0.0.0', config.proxy_port)).Run()
+# In prefork mode (`config.workers` > 1) worker `i` takes its backdoor on
+# the i-th port from `tunnel_port` on (skipping `proxy_port`) and shares
+# `proxy_port` with the other workers.
+def tunnel_port(worker_id):
+    port = config.tunnel_port + worker_id
+    return port + (config.tunnel_port <= config.proxy_port <= port)
+
+# Both listeners stay up for the life of the process: tunnels that break
+# are dropped from the pool and the backdoor's reconnections are accepted
+# again, while clients arriving with no tunnel at all are turned away.
+def start_proxy(worker_id=0, event_loop=Loop):
+    tunnel_server = TunnelServer((config.tunnel_ip, tunnel_port(worker_id)))
+    proxy_server = ProxyServer((config.proxy_ip, config.proxy_port),
+                               num_listens=config.listen_backlog,
+                               reuse_port=(config.workers > 1),
+                               defer_accept=config.defer_accept,
+                               fast_open=config.fast_open)
+    metrics_server = metrics.start_metrics(worker_id, event_loop)
+    start_profiler(worker_id, event_loop)
+    OnTerminate(event_loop,
+                lambda: (tunnel_server.Drain(), proxy_server.Drain(),
+                         metrics_server and metrics_server.Drain()))
+    if tunnel_server.Start(event_loop):
+        proxy_server.Run(event_loop)
 
 class TunnelServer(Server):
+
+    pool = None
+
     def __init__(self, addr):
-        Server.__init__(self, addr, num_listens=1)
+        Server.__init__(self, addr, num_listens=config.tunnels)
+        TunnelServer.pool = TunnelPool()
         
     def handle(self, client_sock, client_addr, event_loop, server_obj):
-        TunnelServer.tunnel = LTunnel(client_sock, client_addr, event_loop)
-        self.Stop()
+        self.pool.Add(LTunnel(client_sock, client_addr, event_loop))
 
 class ProxyServer(Server):
     def handle(self, clt_sock, clt_addr, event_loop, server_obj):
-        TunnelServer.tunnel.AddSrc(clt_sock, clt_addr, clt_sock.fileno())
+        if TunnelServer.pool:
+            TunnelServer.pool.AddSrc(clt_sock, clt_addr)
+        else:
+            self.warn('no tunnel, rejected', '%s:%d' % clt_addr[:2])
+            clt_sock.close()
+
+    def on_drain(self):
+        TunnelServer.pool.Drain()
+
+# The backdoor opens `config.tunnels` parallel tunnel connections so that a
+# lost segment or a full congestion window only holds up the streams of one
+# of them. A new stream goes to the tunnel carrying the fewest streams (then
+# the fewest queued bytes, then round-robin) and stays there until it ends.
+class TunnelPool(object):
+    def __init__(self):
+        self.tunnels = []
+        self.next = 0
+        metrics.TUNNELS.set_function(self.__len__)
+        metrics.TUNNEL_WRITE_BUFFER.set_function(
+            lambda: sum(t.Buffered() for t in self.tunnels))
+
+    def __len__(self):
+        return len(self.tunnels)
+
+    def Add(self, tunnel):
+        tunnel.pool = self
+        self.tunnels.append(tunnel)
+
+    def Remove(self, tunnel):
+        if tunnel in self.tunnels:
+            self.tunnels.remove(tunnel)
+
+    def Pick(self):
+        n = len(self.tunnels)
+        self.next = (self.next + 1) % n
+        order = self.tunnels[self.next:] + self.tunnels[:self.next]
+        return min(order, key=lambda t: (len(t.src_map), t.Buffered()))
 
+    def AddSrc(self, src_sock, src_addr):
+        self.Pick().AddSrc(src_sock, src_addr)
+
+    def Drain(self):
+        for tunnel in list(self.tunnels):
+            tunnel.Drain()
+
+# frames of one stream waiting for their turn to go into the tunnel
+class _StreamQueue(object):
+    __slots__ = 'buf', 'frames', 'deficit', 'weight'
+
+    def __init__(self, weight):
+        self.buf = Buffer()
+        self.frames = collections.deque()   # sizes of the frames in `buf`
+        self.deficit = 0
+        self.weight = weight
+
+# the tunnel protocol is described in frames.py. Each end compresses what it
+# sends at `config.compress_level`, if the peer can decompress.
+#
+# Egress is shared between the streams by deficit round-robin: while the
+# socket keeps up, frames go straight into `write_buf`, once it holds
+# `refill_size` bytes the frames of each stream (DATA, ZDATA and CLOSE)
+# queue up separately instead. Whenever `write_buf` runs low again, the
+# streams with queued frames take turns topping it up, each one with whole
+# frames worth up to `quantum` times its weight per turn (plus what it
+# couldn't use on previous turns). A stream sending a few bytes now and
+# then only waits for one turn of the busy ones rather than for all they
+# have queued, the busy ones share the bandwidth in proportion to their
+# weights. Other frames skip the queues.
 class LTunnel(AsynSocket):
 
     level = 'info'
 
-    def __init__(self, sock, addr, event_loop):
-        AsynSocket.__init__(self, sock, addr, event_loop)
+    # safety net for tunnels carrying many streams: above the high watermark
+    # all local sources stop reading until the tunnel drains
+    high_watermark = 4 * 1024 * 1024
+    low_watermark = 1024 * 1024
+
+    refill_size = 64 * 1024
+    quantum = 16 * 1024
+
+    flush_delay = config.flush_delay
+
+    # socket options profile of the streams' sockets
+    stream_role = 'client'
+
+    hello_flags = HELLO_ZLIB | HELLO_UDP
+
+    # datagrams are dropped rather than queued behind more than this
+    max_datagram_backlog = 256 * 1024
+
+    frame_handlers = {
+        HELLO: 'on_hello', OPEN: 'on_open', DATA: 'on_data_frame',
+        CLOSE: 'close_src', WINDOW_UPDATE: 'on_window',
+        PING: 'on_ping', PONG: 'on_pong', ZDATA: 'on_zdata',
+        ASSOCIATE: 'on_associate', DATAGRAM: 'on_datagram',
+    }
+
+    def __init__(self, sock, addr, event_loop, tag=''):
+        AsynSocket.__init__(self, sock, addr, event_loop, tag)
+        SetSocketOptions(sock, config.sock_opts.get('tunnel', {}))
         self.src_map = {}
-    
+        self.draining = False
+        self.pool = None
+        self.peer_version = None
+        self.peer_flags = 0
+        self.compress_level = 0     # set once the peer can decompress
+        self.compressors = {}       # src_id -> StreamCompressor
+        self.decompressors = {}     # src_id -> zlib decompressor
+        self.queues = {}            # src_id -> _StreamQueue, if not empty
+        self.turns = collections.deque()    # src_ids with queued frames
+        self.in_turn = False        # the first one got its quantum already
+        self.queued = 0
+        self.weights = {}           # src_id -> weight, if not 1
+        self.last_id = 0
+        self.last_recv = self.event_loop.now
+        self._ping_timer = config.ping_interval and \
+            self.event_loop.call_later(config.ping_interval, self._ping_check)
+        self.SendFrame(HELLO, 0, struct.pack('>BB', PROTOCOL_VERSION,
+                                             self.hello_flags))
+
+    # close the tunnel as soon as its last stream is gone
+    def Drain(self):
+        self.draining = True
+        if not self.src_map:
+            self.Close()
+
+    # a tunnel silent for `ping_interval` gets pinged, one still silent an
+    # interval later is taken for dead and dropped
+    def _ping_check(self):
+        silent = self.event_loop.now - self.last_recv
+        if silent >= 2 * config.ping_interval:
+            self.warn('no answer from peer for %.0fs' % silent)
+            self.Abort()
+            return
+        if silent >= config.ping_interval:
+            self.SendFrame(PING, 0, '')
+        self._ping_timer = \
+            self.event_loop.call_later(config.ping_interval, self._ping_check)
+
+    # frames are decoded in place: headers are read at an offset into
+    # `all_data` and payloads handed on as views of it
     def on_data(self, data, all_data):
-        while True:
-            try:
-                pkg_id, pkg_data, all_data = unpack(all_data)
-            except struct.error:
-                return all_data
-            else:
-                self.send_to_src(pkg_id, pkg_data)
-    
-    def on_destroy(self):
-        sys.exit(1)
+        self.last_recv = self.event_loop.now
+        metrics.TUNNEL_RECEIVED.inc(len(data))
+        i, n = 0, len(all_data)
+        while n - i >= HEADER.size and not self.closed:
+            _type, _id, length = HEADER.unpack_from(all_data, i)
+            handler = self.frame_handlers.get(_type)
+            if handler is None or length > MAX_FRAME or \
+                    PAYLOAD_SIZES.get(_type, length) != length or \
+                    (_type == HELLO) != (self.peer_version is None):
+                self.error('protocol error, frame type', _type)
+                self.Abort()
+                return
+            end = i + HEADER.size + length
+            if end > n:
+                break
+            metrics.FRAMES_RECEIVED[_type].inc()
+            getattr(self, handler)(_id, all_data[i+HEADER.size:end])
+            i = end
+        return all_data[i:]
 
-    def send_to_src(self, src_id, data):
+    def on_hello(self, _id, payload):
+        version = struct.unpack_from('>B', payload)[0] if payload else 0
+        if version != PROTOCOL_VERSION:
+            self.error('unsupported protocol version', version)
+            self.Abort()
+            return
+        self.peer_version = version
+        if len(payload) > 1:
+            self.peer_flags = struct.unpack_from('>B', payload, 1)[0]
+        if self.peer_flags & HELLO_ZLIB:
+            self.compress_level = config.compress_level
+
+    def on_open(self, src_id, payload):
+        self.error('unexpected OPEN frame', stream=src_id)
+        self.Abort()
+
+    # the backdoor took a UDP ASSOCIATE, the client gets a relay socket on
+    # the address it reached us at, and its reply from here
+    def on_associate(self, src_id, payload):
+        src = self.src_map.get(src_id, None)
+        if not isinstance(src, SrcSocket) or src.udp is not None:
+            return
+        forward = lambda payload: self._on_client_datagram(src, payload)
         try:
-            src = self.src_map[src_id]
-        except KeyError:
-            pass
+            src.udp = ClientRelay(self.event_loop,
+                                  unmap(src.sock.getsockname()[0]),
+                                  src.sock.getpeername()[0], forward,
+                                  src.name)
+        except socket.error as e:
+            self.warn('failed to relay udp:', e, stream=src_id)
+            reply = socks5.reply(socks5.REP_GENERAL_FAILURE)
         else:
-            if data:
-                src.Send(data)
-            else:
+            reply = socks5.reply(socks5.REP_SUCCEEDED, src.udp.addr)
+        # not sent by the peer, not to be credited to it
+        src.unacked -= len(reply)
+        src.Send(reply)
+        if src.udp is None:
+            src.Close()
+
+    def _on_client_datagram(self, src, payload):
+        src.last_active = self.event_loop.now
+        self.SendDatagram(src.id, payload)
+
+    def on_datagram(self, src_id, payload):
+        src = self.src_map.get(src_id, None)
+        if isinstance(src, SrcSocket) and src.udp is not None:
+            src.last_active = self.event_loop.now
+            src.udp.SendTo(payload)
+
+    def on_ping(self, _id, payload):
+        self.SendFrame(PONG, 0, payload)
+
+    def on_pong(self, _id, payload):
+        pass
+    
+    # the streams can't outlive their tunnel: flush what they have and close
+    def on_destroy(self):
+        self.closed = True
+        if self._ping_timer:
+            self._ping_timer.cancel()
+        for src in list(self.src_map.values()):
+            if isinstance(src, SrcSocket):
                 src.Close()
+            else:
+                src.Cancel()
+        metrics.STREAMS.dec(len(self.src_map))
+        self.src_map.clear()
+        self.compressors.clear()
+        self.decompressors.clear()
+        self.queues.clear()
+        self.turns.clear()
+        self.queued = 0
+        if self.pool is not None:
+            self.pool.Remove(self)
+
+    def on_data_frame(self, src_id, data):
+        # the peer gave up compressing this stream
+        self.decompressors.pop(src_id, None)
+        self.send_to_src(src_id, data)
 
-    def AddSrc(self, src_sock, src_addr, src_id):
+    def on_zdata(self, src_id, payload):
+        if src_id not in self.src_map:
+            return
+        decompressor = self.decompressors.get(src_id)
+        if decompressor is None:
+            decompressor = self.decompressors[src_id] = zlib.decompressobj()
+        data = decompress(decompressor, payload, MAX_FRAME)
+        if data is None:
+            self.error('corrupt ZDATA frame', stream=src_id)
+            self.Abort()
+            return
+        if data:
+            self.send_to_src(src_id, memoryview(data))
+
+    def send_to_src(self, src_id, data):
+        src = self.src_map.get(src_id, None)
+        if isinstance(src, SrcSocket):
+            src.Send(data)
+
+    def close_src(self, src_id, payload):
+        src = self.src_map.get(src_id, None)
+        if isinstance(src, SrcSocket):
+            src.Close()
+        elif src is not None:
+            src.Cancel()
+            self.DelSrc(src_id, notify=False)
+
+    def on_window(self, src_id, payload):
+        src = self.src_map.get(src_id, None)
+        if isinstance(src, SrcSocket):
+            src.send_window += struct.unpack('>I', payload)[0]
+            src.UpdateReading()
+
+    def on_sent(self, data):
+        metrics.TUNNEL_SENDS.inc()
+        metrics.TUNNEL_SENT.inc(len(data))
+
+    def on_pause_writing(self):
+        metrics.TUNNEL_WRITE_PAUSES.inc()
+        self._update_streams_reading()
+
+    def on_resume_writing(self):
+        self._update_streams_reading()
+
+    # the streams read only while the tunnel's writing isn't paused
+    def _update_streams_reading(self):
+        for src in list(self.src_map.values()):
+            if isinstance(src, SrcSocket):
+                src.UpdateReading()
+
+    def Buffered(self):
+        return len(self.write_buf) + self.queued
+
+    # the scheduler, see above
+    def on_refill(self):
+        write_buf, turns = self.write_buf, self.turns
+        while turns and len(write_buf) < self.refill_size:
+            queue = self.queues[turns[0]]
+            if not self.in_turn:
+                queue.deficit += self.quantum * queue.weight
+                self.in_turn = True
+            frames, n = queue.frames, 0
+            while frames and n + frames[0] <= queue.deficit and \
+                    len(write_buf) + n < self.refill_size:
+                n += frames.popleft()
+            if n:
+                data = queue.buf.view()[:n]
+                write_buf.append(data)
+                del data
+                queue.buf.consume(n)
+                queue.deficit -= n
+                self.queued -= n
+            if not frames:
+                del self.queues[turns.popleft()]
+                self.in_turn = False
+            elif frames[0] > queue.deficit:
+                turns.rotate(-1)
+                self.in_turn = False
+
+    # a weight <= 0 never earns a quantum and would stall the queues
+    def SetWeight(self, src_id, weight):
+        if not weight > 0:
+            raise ValueError('stream weight must be > 0, not %r' % (weight,))
+        self.weights[src_id] = weight
+        if src_id in self.queues:
+            self.queues[src_id].weight = weight
+
+    def _drop_queue(self, src_id):
+        queue = self.queues.pop(src_id, None)
+        if queue is not None:
+            if self.turns[0] == src_id:
+                self.in_turn = False
+            self.turns.remove(src_id)
+            self.queued -= len(queue.buf)
+
+    def AddSrc(self, src_sock, src_addr):
+        src_id = self.last_id
+        while True:
+            src_id = src_id % 0xffffffff + 1
+            if src_id not in self.src_map:
+                break
+        self.last_id = src_id
+        metrics.STREAMS.inc()
+        metrics.STREAMS_OPENED.inc()
+        self.SendFrame(OPEN, src_id, '')
         self.src_map[src_id] = \
             SrcSocket(src_sock, src_addr, src_id, self.event_loop, self)
     
     def DelSrc(self, src_id, notify=True):
-        self.src_map.pop(src_id, None)
+        src = self.src_map.pop(src_id, None)
+        if src is not None:
+            metrics.STREAMS.dec()
+        self.decompressors.pop(src_id, None)
+        self.weights.pop(src_id, None)
+        # whatever is still queued would be dropped by the peer
+        if not notify:
+            self._drop_queue(src_id)
+        compressor = self.compressors.pop(src_id, None)
+        if compressor is not None and compressor.raw and \
+                isinstance(src, SrcSocket):
+            src.info('compressed', **compressor.Stats())
         if notify:
-            self.Send(src_id, '')
+            self.SendStreamFrame(CLOSE, src_id, '')
+        if self.draining and not self.src_map and not self.closed:
+            self.Close()
     
+    # the header and the payload are appended to `write_buf` one after the
+    # other, so the payload (often a view of a socket's read buffer) is
+    # copied only once
+    def SendFrame(self, _type, _id, payload):
+        metrics.FRAMES_SENT[_type].inc()
+        AsynSocket.Send(self, HEADER.pack(_type, _id, len(payload)))
+        AsynSocket.Send(self, payload)
+
+    # queued behind the stream's earlier frames if there are any, or if
+    # `write_buf` is full enough for the scheduler to take over
+    def SendStreamFrame(self, _type, src_id, payload):
+        if not self.turns and len(self.write_buf) < self.refill_size:
+            self.SendFrame(_type, src_id, payload)
+            return
+        if self.closed:
+            return
+        metrics.FRAMES_SENT[_type].inc()
+        queue = self.queues.get(src_id)
+        if queue is None:
+            queue = self.queues[src_id] = \
+                _StreamQueue(self.weights.get(src_id, 1))
+            self.turns.append(src_id)
+        queue.buf.append(HEADER.pack(_type, src_id, len(payload)))
+        queue.buf.append(payload)
+        size = HEADER.size + len(payload)
+        queue.frames.append(size)
+        self.queued += size
+        if not self.writing_paused and self.Buffered() > self.high_watermark:
+            self.writing_paused = True
+            self.on_pause_writing()
+
     def Send(self, src_id, data):
-        AsynSocket.Send(self, pack(src_id, data))
+        if self.compress_level:
+            compressor = self.compressors.get(src_id)
+            if compressor is None:
+                compressor = self.compressors[src_id] = \
+                    StreamCompressor(self.compress_level)
+            compressed = compressor.Compress(data)
+            if compressed is not None:
+                self.SendStreamFrame(ZDATA, src_id, compressed)
+                return
+        self.SendStreamFrame(DATA, src_id, data)
+
+    def SendWindow(self, src_id, credit):
+        self.SendFrame(WINDOW_UPDATE, src_id, struct.pack('>I', credit))
+
+    def SendDatagram(self, src_id, payload):
+        if self.Buffered() > self.max_datagram_backlog:
+            metrics.DATAGRAMS_DROPPED['backlog'].inc()
+            return
+        self.SendStreamFrame(DATAGRAM, src_id, payload)
     
 class SrcSocket(AsynSocket):
 
     level = config.log_level
+    idle_timeout = config.idle_timeout
 
     def __init__(self, sock, addr, _id, event_loop, tunnel):
         AsynSocket.__init__(self, sock, addr, event_loop, str(_id))
+        SetSocketOptions(sock, config.sock_opts.get(tunnel.stream_role, {}))
         self.id = _id
         self.tunnel = tunnel
+        # bytes we may still send to the peer / bytes written to our
+        # socket that the peer has not been credited for yet
+        self.send_window = config.stream_window
+        self.unacked = 0
+        self.udp = None     # ClientRelay of a UDP association
+        self.UpdateReading()
+
+    def UpdateReading(self):
+        if self.send_window > 0 and not self.tunnel.writing_paused:
+            self.ResumeReading()
+        else:
+            self.PauseReading()
     
     def on_data(self, data, all_data):
+        metrics.STREAM_RECEIVED.inc(len(data))
         self.tunnel.Send(self.id, data)
+        self.send_window -= len(data)
+        if self.send_window <= 0:
+            self.PauseReading()
+
+    def on_sent(self, data):
+        metrics.STREAM_SENT.inc(len(data))
+        self.unacked += len(data)
+        if self.unacked >= config.stream_window // 4:
+            self.tunnel.SendWindow(self.id, self.unacked)
+            self.unacked = 0
     
     def on_destroy(self):
+        if self.udp is not None:
+            self.udp.Close()
         self.tunnel.DelSrc(self.id, notify=(not self.closed))
 
-def start_backdoor():
-    addr = config.tunnel_ip, config.tunnel_port
-    RTunnel(Connect(addr), addr, None).Run()
+def start_backdoor(worker_id=0, event_loop=Loop):
+    addr = config.tunnel_ip, tunnel_port(worker_id)
+    metrics.start_metrics(worker_id, event_loop)
+    start_profiler(worker_id, event_loop)
+    Backdoor(addr, event_loop).Run()
+
+# Keeps `config.tunnels` tunnels connected to the proxy. A lost tunnel is
+# reconnected at once if it had been up for a while, otherwise after an
+# exponentially growing, jittered delay.
+class Backdoor(TunnelPool, Logger):
+
+    level = 'info'
+
+    min_uptime = 5
+    max_delay = 60
+
+    def __init__(self, addr, event_loop):
+        TunnelPool.__init__(self)
+        self.name = 'Backdoor<%s:%d>' % addr[:2]
+        self.addr, self.event_loop = addr, event_loop
+        self.delays = {}
+        for port, weight in config.stream_weights.items():
+            if not weight > 0:
+                raise ValueError('stream weight of port %r must be > 0, '
+                                 'not %r' % (port, weight))
+        self.warm = config.warm_sockets and \
+            WarmPool(event_loop, config.warm_sockets, config.warm_idle,
+                     config.warm_max_age, config.warm_hosts, config.warm_hot)
+        for i in range(config.tunnels):
+            self._connect(i)
+
+    def Run(self):
+        self.event_loop.run()
+
+    # a tunnel counts as connected once the proxy's HELLO came in
+    def _connect(self, i):
+        try:
+            sock = Connect(self.addr)
+        except socket.error as e:
+            self._reconnect(i, 0, 'failed to connect (%s)' % e)
+            return
+        tunnel = RTunnel(sock, self.addr, self.event_loop, str(i))
+        tunnel.slot, tunnel.started = i, self.event_loop.now
+        self.Add(tunnel)
+        if config.connect_timeout:
+            self.event_loop.call_later(config.connect_timeout,
+                                       self._check_connected, tunnel)
+
+    def _check_connected(self, tunnel):
+        if tunnel.peer_version is None and not tunnel.closed:
+            self.warn('tunnel', tunnel.slot, 'timed out connecting')
+            tunnel.Abort()
+
+    def Remove(self, tunnel):
+        TunnelPool.Remove(self, tunnel)
+        self._reconnect(tunnel.slot, self.event_loop.now - tunnel.started,
+                        'lost')
+
+    def _reconnect(self, i, uptime, reason):
+        if uptime < self.min_uptime:
+            delay = min(max(self.delays.get(i, 0) * 2, 1), self.max_delay)
+        else:
+            delay = 0
+        self.delays[i] = delay
+        delay *= random.uniform(0.5, 1)
+        self.info('tunnel', i, reason + ', reconnecting in %.1fs' % delay)
+        self.event_loop.call_later(delay, self._connect, i)
+
+def run(start):
+    new_loop = lambda: EventLoop(DefaultPoller(config.poller))
+    if config.workers > 1:
+        Supervisor(lambda i: start(i, new_loop()), config.workers).Run()
+    else:
+        start(0, new_loop())
 
 class UnformedSrc:
-    def __init__(self, stage, cmd_buf):
-        self.stage, self.cmd_buf = stage, cmd_buf
+    def __init__(self):
+        self.stage, self.cmd_buf = 0, b''
+        # handshake bytes received from / replied to the client, they take
+        # part in flow control like any other payload
+        self.received, self.replied = 0, 0
+        self.timer = self.connector = None
+
+    def Cancel(self):
+        self.timer.cancel()
+        if self.connector is not None:
+            self.connector.Cancel()
 
 class RTunnel(LTunnel):
+
+    stream_role = 'upstream'
+
+    hello_flags = HELLO_ZLIB
+
+    def __init__(self, sock, addr, event_loop, tag=''):
+        LTunnel.__init__(self, sock, addr, event_loop, tag)
+        self.resolver = GetResolver(self.event_loop,
+                                    nameservers=config.nameservers,
+                                    timeout=config.dns_timeout,
+                                    ipv6=config.ipv6)
+
+    def on_open(self, src_id, payload):
+        if src_id in self.src_map:
+            self.warn('stream opened twice', stream=src_id)
+            return
+        src = self.src_map[src_id] = UnformedSrc()
+        metrics.STREAMS.inc()
+        metrics.STREAMS_OPENED.inc()
+        src.timer = self.event_loop.call_later(config.handshake_timeout,
+                                               self._timeout, src_id, src)
+
+    def on_associate(self, src_id, payload):
+        self.error('unexpected ASSOCIATE frame', stream=src_id)
+        self.Abort()
+
+    def on_datagram(self, src_id, payload):
+        src = self.src_map.get(src_id, None)
+        if isinstance(src, Association):
+            src.Send(payload)
+
     def send_to_src(self, src_id, data):
         src = self.src_map.get(src_id, None)
         if isinstance(src, SrcSocket):
-            if data:
-                src.Send(data)
-            else:
-                src.Close()
-            return
-            
-        if src is None:
-            src = UnformedSrc(stage=0, cmd_buf=data)
-            self.src_map[src_id] = src
-        else:
-            src.cmd_buf += data
-        
-        (src.stage and self._stage1 or self._stage0)(src_id, src)
+            src.Send(data)
+        elif isinstance(src, Association):
+            # nothing more is expected on the control connection
+            self.SendWindow(src_id, len(data))
+        elif src is not None:
+            src.cmd_buf += data.tobytes()
+            src.received += len(data)
+            # stage 2 waits for the resolver, data is just buffered meanwhile
+            if src.stage < 2:
+                (self._stage0, self._stage1)[src.stage](src_id, src)
+
+    def _timeout(self, src_id, src):
+        if self.src_map.get(src_id) is src:
+            self.info('handshake timeout', stream=src_id)
+            metrics.HANDSHAKE_FAILURES['timeout'].inc()
+            src.Cancel()
+            self.DelSrc(src_id)
+
+    def _fail(self, src_id, rep):
+        self.Send(src_id, socks5.reply(rep))
+        self.DelSrc(src_id)
 
     def _stage0(self, src_id, src):
-        cmd_buf = src.cmd_buf
-        
-        if len(cmd_buf) < 3:
-            return
-        
-        n_methods = ord(cmd_buf[1])
-        
-        if (len(cmd_buf) - 2) < n_methods:
+        greeting = socks5.parse_greeting(src.cmd_buf)
+        if greeting is None:
             return
-        
-        ver, methods = ord(cmd_buf[0]), cmd_buf[2:2+n_methods]
-        
-        if ver != 0x05 or '\x00' not in methods:
-            self.Send(src_id, '\x05\xff')
+        ver, methods, n = greeting
+
+        if ver != socks5.VERSION or socks5.METHOD_NO_AUTH not in methods:
+            metrics.HANDSHAKE_FAILURES['method'].inc()
+            self.Send(src_id,
+                      socks5.method_reply(socks5.METHOD_NONE_ACCEPTABLE))
             self.DelSrc(src_id)
             return
        
-        self.Send(src_id, '\x05\x00')
+        self.Send(src_id, socks5.method_reply(socks5.METHOD_NO_AUTH))
+        src.replied += 2
         src.stage = 1
-        src.cmd_buf = cmd_buf[2+n_methods:]
+        src.cmd_buf = src.cmd_buf[n:]
 
         if src.cmd_buf:
             self._stage1(src_id, src)
     
+    # UDP needs a proxy end relaying it
+    def _commands(self):
+        if config.udp_associate and self.peer_flags & HELLO_UDP:
+            return socks5.CMD_CONNECT, socks5.CMD_UDP_ASSOCIATE
+        return socks5.CMD_CONNECT,
+
     def _stage1(self, src_id, src):
-        cmd_buf = src.cmd_buf
-        
-        if len(cmd_buf) < 7:
+        try:
+            request = socks5.parse_request(src.cmd_buf)
+            if request is not None and request[0] not in self._commands():
+                raise socks5.Socks5Error(socks5.REP_COMMAND_NOT_SUPPORTED,
+                                         'unsupported command')
+        except socks5.Socks5Error as e:
+            self.info('bad request:', e, stream=src_id)
+            metrics.HANDSHAKE_FAILURES['request'].inc()
+            self._fail(src_id, e.rep)
             return
-        
-        ver, cmd, rsv, atyp = map(ord, cmd_buf[:4])
-        
-        if ver != 0x05 or cmd != 0x01 or atyp not in (0x01, 0x03):
-            self.DelSrc(src_id)
+        if request is None:
             return
-        
-        if atyp == 0x01:
-            if len(cmd_buf) < 10:
-                return
-            i = 8
-            host = socket.inet_ntoa(cmd_buf[4:i])
-        else:
-            len_host = ord(cmd_buf[4])
-            if len(cmd_buf) < len_host + 7:
-                return
-            i = len_host + 5
-            host = cmd_buf[5:i]
-        
-        port = struct.unpack('>H', cmd_buf[i:i+2])[0]
-        addr = host, port
-        cmd_buf = cmd_buf[i+2:]
-        
-        reply = socket.inet_aton('0.0.0.0')
-        reply += struct.pack(">H", config.proxy_port)
-        
-        try:
-            sock = Connect(addr)
-        except socket.error:
-            self.Send(src_id, '\x05\x04\x00\x01'+reply)
-            self.DelSrc(src_id)
+        cmd, host, port, n = request
+        if cmd == socks5.CMD_UDP_ASSOCIATE:
+            self._associate(src_id, src)
             return
-        
-        self.Send(src_id, '\x05\x00\x00\x01'+reply)
+
+        src.stage = 2
+        src.cmd_buf = src.cmd_buf[n:]
+        self.resolver.Resolve(
+            host, lambda addrs: self._stage2(src_id, src, addrs, port))
+
+    # connect to whichever of the addresses answers first, or take a warm
+    # socket to one of them
+    def _stage2(self, src_id, src, addrs, port):
+        if self.src_map.get(src_id) is not src:
+            return      # closed while resolving
+        if not addrs:
+            metrics.HANDSHAKE_FAILURES['resolve'].inc()
+            self._fail(src_id, socks5.REP_HOST_UNREACHABLE)
+            return
+        addrs = [(addr, port) for addr in addrs]
+        warm = self.pool.warm and self.pool.warm.Get(addrs)
+        if warm:
+            self._stage3(src_id, src, *warm)
+            return
+        callback = lambda sock, addr, err: \
+            self._on_connect(src_id, src, sock, addr, err)
+        src.connector = Connector(self.event_loop, addrs, callback,
+                                  '%s-%d' % (self.name, src_id),
+                                  config.connect_timeout)
+
+    def _on_connect(self, src_id, src, sock, addr, err):
+        src.connector = None
+        if sock is None:
+            self.info('failed to connect:', os.strerror(err), stream=src_id)
+            metrics.HANDSHAKE_FAILURES['connect'].inc()
+            self._fail(src_id, socks5.connect_error_reply(err))
+            return
+        if self.pool.warm:
+            self.pool.warm.Used(addr)
+        self._stage3(src_id, src, sock, addr)
+
+    # the stream becomes an `Association`, what the client sends on its
+    # control connection from now on is dropped (but credited)
+    def _associate(self, src_id, src):
+        src.timer.cancel()
+        self.SendWindow(src_id, src.received)
+        reply = lambda payload: self.SendDatagram(src_id, payload)
+        self.src_map[src_id] = Association(self.event_loop, self.resolver,
+                                           reply, config.udp_timeout,
+                                           '%s-%d' % (self.name, src_id))
+        self.SendStreamFrame(ASSOCIATE, src_id, '')
+
+    # connected, the stream is handed over to a `SrcSocket`
+    def _stage3(self, src_id, src, sock, addr):
+        cmd_buf = src.cmd_buf
+        reply = socks5.reply(socks5.REP_SUCCEEDED, sock.getsockname())
+        self.Send(src_id, reply)
+        # the handshake bytes are consumed here, credit them right away,
+        # what's left in `cmd_buf` is credited once it's sent upstream
+        self.SendWindow(src_id, src.received - len(cmd_buf))
+        src.timer.cancel()
+        weight = config.stream_weights.get(addr[1])
+        if weight:
+            self.SetWeight(src_id, weight)
+        replied = src.replied + len(reply)
         src = SrcSocket(sock, addr, src_id, self.event_loop, self)
+        src.send_window -= replied
         self.src_map[src_id] = src
         
         if cmd_buf:
             src.Send(cmd_buf)
 
-def pack(pkg_id, pkg_data):
-    return struct.pack('>HI', len(pkg_data), pkg_id) + pkg_data
-
-def unpack(pkg):
-    pkg_len, pkg_id = struct.unpack('>HI', pkg[:6])
-    if len(pkg) < (6 + pkg_len):
-        raise struct.error
-    pkg_data, remain = pkg[6:6+pkg_len], pkg[6+pkg_len:]
-    return pkg_id, pkg_data, remain
-
 if __name__ == '__main__':
+    setupLogging(config.log_format, config.log_rate, config.log_buffered)
     if len(sys.argv) == 2 and sys.argv[1] in ('-p', '--start-proxy'):
-        start_proxy()
+        run(start_proxy)
     elif len(sys.argv) == 2 and sys.argv[1] in ('-b', '--start-backdoor'):
-        start_backdoor()
+        run(start_backdoor)
+    elif len(sys.argv) == 2 and sys.argv[1] in ('-d', '--start-direct'):
+        start_direct()
 
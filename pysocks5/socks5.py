@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import socket
+import struct
+
+# SOCKS5 (RFC 1928) messages, shared by the tunnel backdoor and the direct
+# proxy. The parsers take whatever has been received so far (str, bytearray
+# or memoryview) and return None until the message is complete.
+
+VERSION = 0x05
+
+METHOD_NO_AUTH, METHOD_NONE_ACCEPTABLE = 0x00, 0xff
+
+CMD_CONNECT, CMD_UDP_ASSOCIATE = 0x01, 0x03
+
+ATYP_IPV4, ATYP_DOMAIN, ATYP_IPV6 = 0x01, 0x03, 0x04
+
+REP_SUCCEEDED = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_NOT_ALLOWED = 0x02
+REP_NETWORK_UNREACHABLE = 0x03
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+REP_TTL_EXPIRED = 0x06
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ADDRESS_NOT_SUPPORTED = 0x08
+
+class Socks5Error(ValueError):
+    """A malformed request, `rep` is the reply code to answer it with"""
+    def __init__(self, rep, message):
+        ValueError.__init__(self, message)
+        self.rep = rep
+
+def parse_greeting(buf):
+    """Returns (version, methods, length) of the method selection message"""
+    head = bytearray(buf[:257])
+    if len(head) < 2 or len(head) < 2 + head[1]:
+        return None
+    n = 2 + head[1]
+    return head[0], set(head[2:n]), n
+
+def parse_address(buf):
+    """Returns (host, port, length) of an address (type, address and port,
+    as in requests), host is a str for IP addresses and the raw bytes for
+    domain names"""
+    head = bytearray(buf[:259])
+    if len(head) < 2:
+        return None
+    atyp = head[0]
+    if atyp == ATYP_IPV4:
+        n = 7
+    elif atyp == ATYP_DOMAIN:
+        n = 4 + head[1]
+    elif atyp == ATYP_IPV6:
+        n = 19
+    else:
+        raise Socks5Error(REP_ADDRESS_NOT_SUPPORTED,
+                          'unsupported address type %d' % atyp)
+    if len(head) < n:
+        return None
+    if atyp == ATYP_IPV4:
+        host = socket.inet_ntoa(bytes(head[1:5]))
+    elif atyp == ATYP_IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, bytes(head[1:17]))
+    else:
+        host = bytes(head[2:n-2])
+    port = struct.unpack('>H', bytes(head[n-2:n]))[0]
+    return host, port, n
+
+def parse_request(buf):
+    """Returns (cmd, host, port, length) of a request, host as in
+    `parse_address`"""
+    head = bytearray(buf[:262])
+    if len(head) < 5:
+        return None
+    ver, cmd = head[:2]
+    if ver != VERSION:
+        raise Socks5Error(REP_GENERAL_FAILURE, 'bad version %d' % ver)
+    address = parse_address(head[3:])
+    if address is None:
+        return None
+    host, port, n = address
+    return cmd, host, port, 3 + n
+
+def method_reply(method):
+    return struct.pack('>BB', VERSION, method)
+
+def pack_address(addr):
+    """`addr` may be an IPv4 or IPv6 (host, port, ...) tuple"""
+    if ':' in addr[0]:
+        atyp, host = ATYP_IPV6, socket.inet_pton(socket.AF_INET6, addr[0])
+    else:
+        atyp, host = ATYP_IPV4, socket.inet_aton(addr[0])
+    return struct.pack('>B', atyp) + host + struct.pack('>H', addr[1])
+
+def reply(rep, addr=('0.0.0.0', 0)):
+    return struct.pack('>BBB', VERSION, rep, 0) + pack_address(addr)
+
+# UDP datagrams to and from a client are prefixed by a header made of two
+# reserved bytes, a fragment number and the address (the destination of the
+# datagram or its source). Fragments are not supported.
+def parse_udp_header(buf):
+    """Returns (fragment, host, port, length) of the header of a datagram,
+    None if it is truncated"""
+    head = bytearray(buf[:262])
+    if len(head) < 4:
+        return None
+    address = parse_address(head[3:])
+    if address is None:
+        return None
+    host, port, n = address
+    return head[2], host, port, 3 + n
+
+def udp_header(addr):
+    return b'\x00\x00\x00' + pack_address(addr)
+
+# a connect that timed out is answered with "TTL expired", like most
+# servers do
+_connect_errors = {
+    errno.ECONNREFUSED: REP_CONNECTION_REFUSED,
+    errno.ENETUNREACH: REP_NETWORK_UNREACHABLE,
+    errno.ENETDOWN: REP_NETWORK_UNREACHABLE,
+    errno.EHOSTUNREACH: REP_HOST_UNREACHABLE,
+    errno.EHOSTDOWN: REP_HOST_UNREACHABLE,
+    errno.ETIMEDOUT: REP_TTL_EXPIRED,
+    errno.EACCES: REP_NOT_ALLOWED,
+    errno.EPERM: REP_NOT_ALLOWED,
+}
+
+def connect_error_reply(err):
+    """Maps the errno of a failed connect to a reply code"""
+    return _connect_errors.get(err, REP_GENERAL_FAILURE)
@@ -1,18 +1,51 @@
 #!/env/bin/python
 # -*- coding: utf-8 -*-
 
+import errno
+import os
 import socket
 import sys
 
+from buffer import Buffer, Pool
 from eventloop import Loop, EV_READ, EV_WRITE, EV_ERROR
 from logger import Logger
 
+# IPv6 literals have colons, anything else is taken for IPv4
+def Family(addr):
+    return socket.AF_INET6 if ':' in addr[0] else socket.AF_INET
+
+# starts a non-blocking connect, whose completion shows up as writability
+# (and its failure as an error on the first recv/send), raises
+# `socket.error` if it fails right away
 def Connect(server_addr):    
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock = socket.socket(Family(server_addr), socket.SOCK_STREAM)
     sock.setblocking(0)
-    sock.connect_ex(server_addr)
+    err = sock.connect_ex(server_addr)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        sock.close()
+        raise socket.error(err, os.strerror(err))
     return sock
 
+# `SetSocketOptions(sock, {'nodelay': 1, 'sndbuf': 65536})`, options the
+# platform lacks are skipped. There is no TCP_CORK: set once and left on, it
+# holds every partial segment for up to 200ms, and the writes are already
+# batched by `flush_delay` instead.
+_SOCKET_OPTIONS = {
+    'nodelay': (socket.IPPROTO_TCP, socket.TCP_NODELAY),
+    'quickack': (socket.IPPROTO_TCP, getattr(socket, 'TCP_QUICKACK', None)),
+    'keepalive': (socket.SOL_SOCKET, socket.SO_KEEPALIVE),
+    'sndbuf': (socket.SOL_SOCKET, socket.SO_SNDBUF),
+    'rcvbuf': (socket.SOL_SOCKET, socket.SO_RCVBUF),
+}
+
+def SetSocketOptions(sock, options):
+    for name, value in options.items():
+        if name not in _SOCKET_OPTIONS:
+            raise ValueError('unknown socket option %r' % name)
+        level, option = _SOCKET_OPTIONS[name]
+        if option is not None:
+            sock.setsockopt(level, option, value)
+
 # user defined methods' name convention:
 #   Method -- public: callable, un-inheritable
 #   method -- protected: un-callable, inheritable
@@ -22,6 +55,37 @@ def Connect(server_addr):
 #   _attribute -- hidden
 
 class AsynSocket(Logger):
+
+    # seconds without any successful recv/send before the socket is closed,
+    # 0 disables the idle timer
+    idle_timeout = 0
+
+    # `on_pause_writing` is called once `write_buf` grows above the high
+    # watermark, `on_resume_writing` once it drains to the low one again.
+    # Producers feeding this socket should stop reading in between.
+    high_watermark = 256 * 1024
+    low_watermark = 64 * 1024
+
+    # sockets queueing data of their own hand it over to `write_buf` bit by
+    # bit from `on_refill`, called whenever a write leaves it with fewer
+    # than `refill_size` bytes, 0 never calls it
+    refill_size = 0
+
+    # whatever is sent within one loop iteration goes out with one `send`,
+    # with `flush_delay` seconds the first bytes wait that long for more
+    # (unless `flush_size` bytes come together sooner), for fewer and
+    # fuller packets at the cost of latency
+    flush_delay = 0
+    flush_size = 64 * 1024
+
+    # reads go into pooled buffers of `recv_size` bytes, doubled after a
+    # full read and halved after one that filled less than a quarter of it.
+    # A wakeup reads until the socket is drained or `read_budget` bytes
+    # came in, so that one busy socket can't starve the others.
+    min_recv_size = 4 * 1024
+    max_recv_size = 256 * 1024
+    read_budget = 1024 * 1024
+
     def __init__(self, sock, addr, event_loop=None, tag=''):
         self.fd = sock.fileno()
         self.name = '%s<%s:%d>' % (self.__class__.__name__, addr[0], addr[1])
@@ -29,45 +93,90 @@ class AsynSocket(Logger):
         self.sock = sock
         self.event_loop = event_loop or Loop
         self.Run = self.event_loop.run
-        self.read_buf = ''
-        self.write_buf = []
+        self.read_buf = Buffer()
+        self.write_buf = Buffer()
         self.sock.setblocking(0)
         self.event_loop.register(self.fd, EV_READ, self._on_read)
-        self.event_loop.register(self.fd, EV_WRITE, self._on_write)
         self.event_loop.register(self.fd, EV_ERROR, self._on_error)
         self.closed = False
+        self.reading_paused = False
+        self.writing_paused = False
+        self.recv_size = self.min_recv_size
+        self._destroyed = False
+        self._flush_timer = None
+        self.last_active = self.event_loop.now
+        self._idle_timer = self.idle_timeout and \
+            self.event_loop.call_later(self.idle_timeout, self._on_idle_check)
         self.info('created')
 
-    def _on_read(self):
-        try:
-            data = self.sock.recv(4096)
-        except socket.error:
-            self._on_error()
+    def _on_idle_check(self):
+        left = self.last_active + self.idle_timeout - self.event_loop.now
+        if left > 0:
+            self._idle_timer = \
+                self.event_loop.call_later(left, self._on_idle_check)
         else:
-            if data:
-                self.debug('recv', len(data), 'bytes')
-                self.dump(data)
-                self.read_buf = self.on_data(data, self.read_buf+data) or ''
-            else:
+            self.info('idle timeout')
+            self._on_close()
+
+    def _on_read(self):
+        budget = self.read_budget
+        while budget > 0:
+            size = self.recv_size
+            buf = Pool.get(size)
+            try:
+                n = self.sock.recv_into(buf, size)
+            except socket.error as e:
+                Pool.put(buf)
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._on_error()
+                return
+            if not n:
+                Pool.put(buf)
                 self._on_remote_close()
+                return
+            self.last_active = self.event_loop.now
+            self.debug('recv', n, 'bytes')
+            data = memoryview(buf)[:n]
+            self.dump(data)
+            self.read_buf.feed(data, self.on_data)
+            del data
+            Pool.put(buf)
+            budget -= n
+            if n < size:
+                if n < size // 4:
+                    self.recv_size = max(size // 2, self.min_recv_size)
+                return      # drained
+            self.recv_size = min(size * 2, self.max_recv_size)
+            if self._destroyed or self.closed or self.reading_paused:
+                return
 
     def _on_write(self):
         if self.write_buf:
-            data = ''.join(self.write_buf)
+            data = self.write_buf.view()
             try:
                 n = self.sock.send(data)
             except socket.error:
+                del data
                 self._on_error()
-            else:
-                del self.write_buf[:]
-                if n > 0:
-                    sent, data = data[:n], data[n:]
-                    self.debug('sent', n, 'bytes')
-                    self.dump(sent)
-                    self.on_sent(sent)
-                if data:
-                    self.write_buf.append(data)
-                    return
+                return
+            if n > 0:
+                self.last_active = self.event_loop.now
+                sent = data[:n]
+                self.debug('sent', n, 'bytes')
+                self.dump(sent)
+                self.on_sent(sent)
+                del sent
+            del data
+            self.write_buf.consume(n)
+            if len(self.write_buf) < self.refill_size:
+                self.on_refill()
+            if self.writing_paused and self.Buffered() <= self.low_watermark:
+                self.writing_paused = False
+                self.on_resume_writing()
+            if self.write_buf:
+                return
+        # only wait for writability while there is something to write
+        self.event_loop.unregister(self.fd, EV_WRITE)
         if self.closed:
             self._on_close()
     
@@ -88,16 +197,62 @@ class AsynSocket(Logger):
 
     def Close(self):
         self.closed = True
+        if self._flush_timer:
+            self._flush()
         if not self.write_buf:
             self._on_close()
         else:
             self.event_loop.unregister(self.fd, EV_READ)
-    
+
+    # close at once, dropping whatever is still waiting to be sent
+    def Abort(self):
+        self.closed = True
+        self._on_close()
+
     def Send(self, data):
         if not self.closed and data:
+            if not self.write_buf:
+                if self.flush_delay:
+                    self._flush_timer = self.event_loop.call_later(
+                        self.flush_delay, self._flush)
+                else:
+                    self.event_loop.register(self.fd, EV_WRITE,
+                                             self._on_write)
             self.write_buf.append(data)
+            if self._flush_timer and len(self.write_buf) >= self.flush_size:
+                self._flush()
+            if not self.writing_paused and \
+                    self.Buffered() > self.high_watermark:
+                self.writing_paused = True
+                self.on_pause_writing()
+
+    def _flush(self):
+        if self._flush_timer:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self.event_loop.register(self.fd, EV_WRITE, self._on_write)
+
+    # bytes waiting to be sent, the watermarks apply to them
+    def Buffered(self):
+        return len(self.write_buf)
+
+    def PauseReading(self):
+        if not self.reading_paused:
+            self.reading_paused = True
+            self.event_loop.unregister(self.fd, EV_READ)
+
+    def ResumeReading(self):
+        if self.reading_paused:
+            self.reading_paused = False
+            if not self.closed:
+                self.event_loop.register(self.fd, EV_READ, self._on_read)
     
     def _destroy(self):
+        self._destroyed = True
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        if self._flush_timer:
+            self._flush_timer.cancel()
         self.event_loop.unregister_all(self.fd)
         self.sock.close()
         self.on_destroy()
@@ -108,6 +263,15 @@ class AsynSocket(Logger):
     def on_sent(self, data):
         pass
     
+    def on_pause_writing(self):
+        pass
+
+    def on_resume_writing(self):
+        pass
+
+    def on_refill(self):
+        pass
+
     def on_error(self):
         pass
     
@@ -133,32 +297,83 @@ def test_client(server_addr):
             self.Send(s.format(server_addr[0]))
 
     for i in range(3):
-        Loop.add_timeout(0, HttpClient, server_addr, i)
+        Loop.call_later(0, HttpClient, server_addr, i)
 
     Loop.run()
 
+# not exported by python2's socket module, these are the linux values
+_linux = sys.platform.startswith('linux')
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if _linux else None)
+TCP_DEFER_ACCEPT = getattr(socket, 'TCP_DEFER_ACCEPT', 9 if _linux else None)
+TCP_FASTOPEN = getattr(socket, 'TCP_FASTOPEN', 23 if _linux else None)
+
+# For listeners whose clients speak first: with `defer_accept` seconds a
+# connection only becomes acceptable once its first data came in (or the
+# time is up), with a `fast_open` queue length clients may send that data
+# along with their SYN. Both are left off where the platform lacks them.
+def SetListenOptions(sock, defer_accept=0, fast_open=0):
+    if defer_accept and TCP_DEFER_ACCEPT is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_DEFER_ACCEPT, defer_accept)
+    if fast_open and TCP_FASTOPEN is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN, fast_open)
+
+# accept errors about a single connection, not the listener
+ACCEPT_SKIP_ERRORS = errno.ECONNABORTED, errno.EPROTO
+ACCEPT_NOFILE_ERRORS = errno.EMFILE, errno.ENFILE
+
 class Server(Logger):
-    def __init__(self, server_addr, connection_handler=None, num_listens=10):
+
+    # connections accepted per wakeup at most, a burst is taken in batches
+    # instead of one per loop iteration, without starving the sockets
+    # already being served
+    accept_batch = 64
+
+    # `reuse_port` lets several processes bind the same address, each one
+    # getting its own accept queue (SO_REUSEPORT). `num_listens` is the
+    # backlog, capped by the kernel (net.core.somaxconn on linux).
+    def __init__(self, server_addr, connection_handler=None, num_listens=128,
+                 reuse_port=False, defer_accept=0, fast_open=0):
         self.name = self.__class__.__name__ + ('<%s:%d>' % server_addr)
         self.addr = server_addr
         self.connection_handler = connection_handler or self.handle
         self.num_listens = num_listens
+        self.reuse_port = reuse_port
+        self.defer_accept, self.fast_open = defer_accept, fast_open
+        self.draining = False
     
-    def Run(self, event_loop=Loop):
+    # bind and register the listener without running the loop, so that
+    # several servers can share one loop
+    def Start(self, event_loop=Loop):
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            family = Family(self.addr)
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
             self.sock.setblocking(0)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6:
+                # '::' takes IPv4 clients as well
+                self.sock.setsockopt(socket.IPPROTO_IPV6,
+                                     socket.IPV6_V6ONLY, 0)
+            if self.reuse_port:
+                if SO_REUSEPORT is None:
+                    raise socket.error('SO_REUSEPORT is not supported')
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            SetListenOptions(self.sock, self.defer_accept, self.fast_open)
             self.sock.bind(self.addr)
             self.sock.listen(self.num_listens)
         except socket.error as e:
             self.notify('failed to start')
             self.on_failed_to_start(e)
-        else:
-            fd = self.sock.fileno()
-            event_loop.register(fd, EV_READ, self._on_accept, event_loop)
-            self.notify('started')
-            self.on_start()
+            return False
+        fd = self.sock.fileno()
+        event_loop.register(fd, EV_READ, lambda: self._on_accept(event_loop))
+        self.fd, self.event_loop = fd, event_loop
+        self.notify('started')
+        self.on_start()
+        return True
 
+    def Run(self, event_loop=Loop):
+        if self.Start(event_loop):
+            fd = self.fd
             try:
                 event_loop.run()
             except KeyboardInterrupt:
@@ -177,9 +392,37 @@ class Server(Logger):
     def Stop(self):
         raise SystemExit
 
+    # stop accepting but keep serving the connections already accepted,
+    # `Run` returns once they are all gone
+    def Drain(self):
+        if self.draining:
+            return
+        self.draining = True
+        self.notify('draining')
+        self.event_loop.unregister(self.fd, EV_READ)
+        self.sock.close()
+        self.on_drain()
+
     def _on_accept(self, event_loop):
-        client_sock, client_addr = self.sock.accept()
-        self.connection_handler(client_sock, client_addr, event_loop, self)  
+        for i in range(self.accept_batch):
+            try:
+                client_sock, client_addr = self.sock.accept()
+            except socket.error as e:
+                # drained, or another process sharing the listener got
+                # there first
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] in ACCEPT_SKIP_ERRORS:
+                    continue
+                # the connections wait in the backlog until some close
+                if e.args[0] in ACCEPT_NOFILE_ERRORS:
+                    self.warn('accept failed:', e)
+                    return
+                raise
+            self.connection_handler(client_sock, client_addr, event_loop,
+                                    self)
+            if self.draining:
+                return
     
     def on_failed_to_start(self, e):
         sys.exit(1)
@@ -193,6 +436,9 @@ class Server(Logger):
     def on_stop(self):
         pass
 
+    def on_drain(self):
+        pass
+
     def on_crash(self, e):
         sys.exit(1)
     
@@ -218,7 +464,7 @@ def test_server(server_addr):
         def on_data(self, data, all_data):
             if len(all_data) < 16:
                 return all_data
-            if all_data.startswith('GET / HTTP/1.1\r\n'):
+            if all_data[:16].tobytes() == 'GET / HTTP/1.1\r\n':
                 self.Send(self.response)
             self.Close()
 
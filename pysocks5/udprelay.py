@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import socket
+
+from eventloop import EV_READ
+from logger import Logger
+from sockserver import Family
+
+import config
+import metrics
+import socks5
+
+# UDP ASSOCIATE (RFC 1928). The client of an association gets a
+# `ClientRelay`, a UDP socket it sends its datagrams to, prefixed by the
+# socks5 UDP header, and gets the replies from. The datagrams go on to an
+# `Association` (over the tunnel in DATAGRAM frames, see frames.py, unless
+# in direct mode), which sends them to their destinations from UDP sockets
+# of its own, one per address family, and passes back what comes in from
+# the destinations it sent to within the last `timeout` seconds, its NAT
+# table. Anything else is dropped. An association lasts as long as the
+# client's TCP connection.
+#
+# Python has no `recvmmsg`, both drain their sockets with up to `batch`
+# `recvfrom` calls per wakeup instead of one, what they pass on over the
+# tunnel then goes out with a single send.
+
+_AGAIN = errno.EAGAIN, errno.EWOULDBLOCK
+
+# an IPv4 client on a dual stack listener shows up as ::ffff:a.b.c.d
+def unmap(ip):
+    return ip[7:] if ip.startswith('::ffff:') and '.' in ip else ip
+
+def _recv_batch(sock, batch, on_error):
+    # yields (data, (ip, port)) of up to `batch` datagrams
+    for i in range(batch):
+        try:
+            data, addr = sock.recvfrom(65535)
+        except socket.error as e:
+            if e.args[0] not in _AGAIN:
+                on_error(e)
+            return
+        yield data, (unmap(addr[0]), addr[1])
+
+class ClientRelay(Logger):
+
+    level = config.log_level
+
+    batch = 64
+
+    # `forward(payload)` gets the datagrams of the client as DATAGRAM
+    # payloads, the ones from other addresses than `client_ip` are dropped
+    def __init__(self, event_loop, local_ip, client_ip, forward,
+                 name='ClientRelay'):
+        self.name = name
+        self.event_loop = event_loop
+        self.client_ip = unmap(client_ip)
+        self.client_addr = None     # where the client last sent from
+        self.forward = forward
+        self.sock = socket.socket(Family((local_ip,)), socket.SOCK_DGRAM)
+        try:
+            self.sock.setblocking(0)
+            self.sock.bind((local_ip, 0))
+        except socket.error:
+            self.sock.close()
+            raise
+        self.addr = self.sock.getsockname()
+        self.fd = self.sock.fileno()
+        event_loop.register(self.fd, EV_READ, self._on_readable)
+        self.info('relaying udp on %s:%d' % self.addr[:2])
+
+    def _on_readable(self):
+        for data, addr in _recv_batch(self.sock, self.batch, self._on_error):
+            if addr[0] != self.client_ip:
+                metrics.DATAGRAMS_DROPPED['filtered'].inc()
+                continue
+            try:
+                header = socks5.parse_udp_header(data)
+            except socks5.Socks5Error:
+                header = None
+            if header is None or header[0] != 0:
+                metrics.DATAGRAMS_DROPPED['malformed'].inc()
+                continue
+            self.client_addr = addr
+            metrics.DATAGRAMS_RELAYED['up'].inc()
+            self.forward(data[3:])
+
+    def _on_error(self, e):
+        self.info('recv failed:', e)
+
+    # `payload` is a DATAGRAM payload, the source address and the datagram
+    def SendTo(self, payload):
+        if self.client_addr is None:
+            metrics.DATAGRAMS_DROPPED['filtered'].inc()
+            return
+        if isinstance(payload, memoryview):
+            payload = payload.tobytes()
+        try:
+            self.sock.sendto(b'\x00\x00\x00' + payload, self.client_addr)
+        except socket.error as e:
+            self.debug('send failed:', e)
+            metrics.DATAGRAMS_DROPPED['send'].inc()
+            return
+        metrics.DATAGRAMS_RELAYED['down'].inc()
+
+    def Close(self):
+        if self.sock is None:
+            return
+        self.event_loop.unregister_all(self.fd)
+        self.sock.close()
+        self.sock = None
+
+class Association(Logger):
+
+    level = config.log_level
+
+    batch = 64
+
+    # destinations in the NAT table at most
+    max_peers = 1024
+
+    # `reply(payload)` gets the datagrams from the destinations as DATAGRAM
+    # payloads
+    def __init__(self, event_loop, resolver, reply, timeout=120,
+                 name='Association'):
+        self.name = name
+        self.event_loop = event_loop
+        self.resolver = resolver
+        self.reply = reply
+        self.timeout = timeout
+        self.socks = {}         # family -> socket
+        self.peers = {}         # (ip, port) -> time of the last datagram
+        self.closed = False
+        metrics.ASSOCIATIONS.inc()
+        # entries live between `timeout` and 1.5 times that
+        self.timer = event_loop.call_later(timeout / 2.0, self._expire)
+
+    # `payload` is a DATAGRAM payload, the destination and the datagram
+    def Send(self, payload):
+        try:
+            address = socks5.parse_address(payload)
+        except socks5.Socks5Error:
+            address = None
+        if address is None:
+            metrics.DATAGRAMS_DROPPED['malformed'].inc()
+            return
+        host, port, n = address
+        data = payload[n:]
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.resolver.Resolve(
+            host, lambda addrs: self._send_to(addrs, port, data))
+
+    def _send_to(self, addrs, port, data):
+        if self.closed:
+            return
+        if not addrs:
+            metrics.DATAGRAMS_DROPPED['resolve'].inc()
+            return
+        # the first address that takes it, e.g. on a host without IPv6
+        # the AAAA ones fail and the A ones are next
+        for ip in addrs:
+            addr = ip, port
+            if addr not in self.peers and len(self.peers) >= self.max_peers:
+                metrics.DATAGRAMS_DROPPED['peers'].inc()
+                return
+            try:
+                self._socket(Family(addr)).sendto(data, addr)
+            except socket.error as e:
+                self.debug('send to %s:%d failed:' % addr, e)
+                continue
+            self.peers[addr] = self.event_loop.now
+            metrics.DATAGRAMS_RELAYED['up'].inc()
+            return
+        metrics.DATAGRAMS_DROPPED['send'].inc()
+
+    def _socket(self, family):
+        sock = self.socks.get(family)
+        if sock is None:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            sock.bind(('::' if family == socket.AF_INET6 else '0.0.0.0', 0))
+            self.socks[family] = sock
+            self.event_loop.register(sock.fileno(), EV_READ,
+                                     lambda: self._on_readable(sock))
+        return sock
+
+    def _on_readable(self, sock):
+        for data, addr in _recv_batch(sock, self.batch, self._on_error):
+            if addr not in self.peers:
+                metrics.DATAGRAMS_DROPPED['filtered'].inc()
+                continue
+            self.peers[addr] = self.event_loop.now
+            metrics.DATAGRAMS_RELAYED['down'].inc()
+            self.reply(socks5.pack_address(addr) + data)
+
+    def _on_error(self, e):
+        # e.g. ECONNREFUSED from an ICMP port unreachable
+        self.debug('recv failed:', e)
+
+    def _expire(self):
+        now = self.event_loop.now
+        for addr, last in list(self.peers.items()):
+            if now - last >= self.timeout:
+                del self.peers[addr]
+        self.timer = self.event_loop.call_later(self.timeout / 2.0,
+                                                self._expire)
+
+    def Cancel(self):
+        if self.closed:
+            return
+        self.closed = True
+        metrics.ASSOCIATIONS.dec()
+        self.timer.cancel()
+        for sock in self.socks.values():
+            self.event_loop.unregister_all(sock.fileno())
+            sock.close()
+        self.socks.clear()
+        self.peers.clear()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import socket
+
+from eventloop import EV_READ, EV_WRITE
+from logger import Logger
+from sockserver import Connect
+
+import config
+import metrics
+
+# Pre-connected upstream sockets for the backdoor, keyed by (ip, port).
+# Once a destination is hot, connected to `hot` times with less than `idle`
+# seconds between one and the next, `size` connections to it are kept open
+# until it goes unused for `idle` seconds (the `hosts` given upfront are
+# kept forever), so that the next CONNECT to it can skip the TCP handshake.
+# One-off destinations are only counted, in a table of at most `max_tracked`
+# entries that is purged of the stale ones every `idle` seconds. Each warm
+# socket is replaced after `max_age` seconds, before the server gets tired
+# of waiting for a request, and dropped as soon as the server closes it.
+# Failed connects are not retried until the destination is asked for again.
+
+class _Warm(object):
+    __slots__ = 'sock', 'fd', 'ready', 'timer'
+
+    def __init__(self, sock):
+        self.sock, self.fd = sock, sock.fileno()
+        self.ready = False
+        self.timer = None
+
+def _healthy(sock):
+    # readable means closed by the server, unless it spoke first
+    try:
+        return bool(sock.recv(1, socket.MSG_PEEK))
+    except socket.error as e:
+        return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+class WarmPool(Logger):
+
+    level = config.log_level
+
+    # destinations warmed at the same time
+    max_hosts = 64
+    # destinations whose use is counted at the same time
+    max_tracked = 4096
+
+    def __init__(self, event_loop, size, idle=60, max_age=20, hosts=(),
+                 hot=3):
+        self.name = 'WarmPool'
+        self.event_loop = event_loop
+        self.size, self.idle, self.max_age = size, idle, max_age
+        self.hot = hot
+        self.socks = {}         # addr -> [_Warm, ...], connecting or ready
+        self.uses = {}          # addr -> [uses in a row, time of the last]
+        self.purge_timer = None
+        self.hosts = set(hosts)
+        for addr in self.hosts:
+            self._fill(addr)
+
+    def Get(self, addrs):
+        """Returns (socket, addr) connected to one of `addrs`, or None if
+        none is ready"""
+        for addr in addrs:
+            for warm in list(self.socks.get(addr, ())):
+                if not warm.ready:
+                    continue
+                if _healthy(warm.sock):
+                    self._remove(addr, warm)
+                    metrics.WARM_HITS.inc()
+                    self.Used(addr)
+                    return warm.sock, addr
+                self._drop(addr, warm)
+        metrics.WARM_MISSES.inc()
+        return None
+
+    # counts a connection to `addr`, which is kept warm for the next `idle`
+    # seconds once hot
+    def Used(self, addr):
+        now = self.event_loop.now
+        use = self.uses.get(addr)
+        if use is None:
+            if len(self.uses) >= self.max_tracked:
+                return
+            use = self.uses[addr] = [0, now]
+            if self.purge_timer is None:
+                self.purge_timer = \
+                    self.event_loop.call_later(self.idle, self._purge)
+        elif now - use[1] >= self.idle:
+            use[0] = 0
+        use[0] += 1
+        use[1] = now
+        if use[0] >= self.hot:
+            self._fill(addr)
+
+    def _wanted(self, addr):
+        if addr in self.hosts:
+            return True
+        use = self.uses.get(addr)
+        return use is not None and use[0] >= self.hot and \
+            self.event_loop.now - use[1] < self.idle
+
+    def _purge(self):
+        now = self.event_loop.now
+        for addr, use in list(self.uses.items()):
+            if now - use[1] >= self.idle and addr not in self.socks:
+                del self.uses[addr]
+        self.purge_timer = None
+        if self.uses:
+            self.purge_timer = \
+                self.event_loop.call_later(self.idle, self._purge)
+
+    def _fill(self, addr):
+        if addr not in self.socks and len(self.socks) >= self.max_hosts:
+            return
+        for i in range(self.size - len(self.socks.get(addr, ()))):
+            try:
+                warm = _Warm(Connect(addr))
+            except socket.error as e:
+                self.info('failed to connect to %s:%d:' % addr, e)
+                return
+            self.socks.setdefault(addr, []).append(warm)
+            self.event_loop.register(
+                warm.fd, EV_WRITE, lambda w=warm: self._on_connected(addr, w))
+            warm.timer = self.event_loop.call_later(
+                self.max_age, self._expire, addr, warm)
+
+    def _on_connected(self, addr, warm):
+        err = warm.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.info('failed to connect to %s:%d' % addr)
+            self._drop(addr, warm)
+            return
+        warm.ready = True
+        self.event_loop.unregister(warm.fd, EV_WRITE)
+        self.event_loop.register(warm.fd, EV_READ,
+                                 lambda: self._on_readable(addr, warm))
+
+    def _on_readable(self, addr, warm):
+        if _healthy(warm.sock):
+            # the data is left for whoever gets the socket
+            self.event_loop.unregister(warm.fd, EV_READ)
+        else:
+            self._drop(addr, warm)
+
+    def _expire(self, addr, warm):
+        warm.timer = None
+        self._drop(addr, warm)
+        if self._wanted(addr):
+            self._fill(addr)
+
+    def _remove(self, addr, warm):
+        if warm.timer is not None:
+            warm.timer.cancel()
+        self.event_loop.unregister_all(warm.fd)
+        socks = self.socks[addr]
+        socks.remove(warm)
+        if not socks:
+            del self.socks[addr]
+
+    def _drop(self, addr, warm):
+        self._remove(addr, warm)
+        warm.sock.close()
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# the modules of pysocks5 import each other by their bare names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'pysocks5'))
+
+# asyncio only, with syntax python 2 can't even compile
+collect_ignore = [] if sys.version_info >= (3, 5) else ['test_aio.py']
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import random
+import unittest
+
+from aio import TunnelProtocol
+from frames import DATA, WINDOW_UPDATE, HEADER
+
+class _Transport(object):
+    def __init__(self):
+        self.aborted = False
+
+    def is_closing(self):
+        return self.aborted
+
+    def abort(self):
+        self.aborted = True
+
+class _Tunnel(TunnelProtocol):
+    def __init__(self):
+        TunnelProtocol.__init__(self)
+        self.transport = _Transport()
+        self.peer_version = 1       # past the HELLO
+        self.received = []
+
+    def on_data(self, stream_id, payload):
+        self.received.append((stream_id, bytes(payload)))
+
+class FrameDecodingTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        rand = random.Random(1)
+        self.frames = [(i, bytes(bytearray(rand.randrange(256)
+                                           for j in range(size))))
+                       for i, size in enumerate([0, 1, 9, 100, 70000])]
+        self.stream = b''.join(HEADER.pack(DATA, i, len(payload)) + payload
+                               for i, payload in self.frames)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def feed(self, sizes):
+        tunnel, i = _Tunnel(), 0
+        for size in sizes:
+            tunnel.data_received(self.stream[i:i+size])
+            i += size
+        tunnel.data_received(self.stream[i:])
+        self.assertFalse(tunnel.transport.aborted)
+        self.assertEqual(tunnel.received, self.frames)
+        self.assertFalse(tunnel.rest)
+
+    def test_whole(self):
+        self.feed([])
+
+    def test_byte_by_byte(self):
+        self.feed([1] * len(self.stream))
+
+    def test_random_splits(self):
+        rand = random.Random(2)
+        self.feed([rand.randrange(1, 5000) for i in range(100)])
+
+    def test_bad_window_update(self):
+        tunnel = _Tunnel()
+        tunnel.data_received(HEADER.pack(WINDOW_UPDATE, 1, 2) + b'\x00\x01')
+        self.assertTrue(tunnel.transport.aborted)
+
+if __name__ == '__main__':
+    unittest.main()
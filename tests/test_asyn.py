@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import unittest
+
+from asyn import Socket
+from eventloop import EventLoop
+
+class SocketTest(unittest.TestCase):
+    def test_connect_fails_at_once(self):
+        # a connect to the broadcast address fails before any packet is sent
+        self.assertRaises(socket.error, Socket, None,
+                          ('255.255.255.255', 80), '', EventLoop())
+
+if __name__ == '__main__':
+    unittest.main()
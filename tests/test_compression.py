@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+import zlib
+
+from compression import StreamCompressor, decompress
+
+TEXT = b''.join(b'{"id": %d, "name": "item %d", "tags": ["a", "b"]}\n' % (i, i)
+                for i in range(2000))
+
+class StreamCompressorTest(unittest.TestCase):
+    def setUp(self):
+        self.compressor = StreamCompressor(6)
+        self.decompressor = zlib.decompressobj()
+
+    def send(self, data):
+        # what the peer ends up with, and whether it came compressed
+        out = self.compressor.Compress(memoryview(data))
+        if out is None:
+            return data, False
+        return decompress(self.decompressor, out, 1 << 20), True
+
+    def test_small_chunks_sent_as_is(self):
+        for i in range(100):
+            self.assertEqual(self.send(TEXT[:64]), (TEXT[:64], False))
+        # no zlib state for streams that never send much at once
+        self.assertIsNone(self.compressor.compressor)
+        self.assertFalse(self.compressor.given_up)
+
+    def test_compressible(self):
+        chunks = [TEXT[i:i+4096] for i in range(0, len(TEXT), 4096)]
+        # small chunks too once the stream is compressed
+        chunks.insert(3, b'x')
+        for chunk in chunks:
+            self.assertEqual(self.send(chunk), (chunk, True))
+        stats = self.compressor.Stats()
+        self.assertFalse(stats['given_up'])
+        self.assertLess(stats['ratio'], 0.3)
+
+    def test_incompressible_first_chunk(self):
+        data = os.urandom(1024)
+        self.assertEqual(self.send(data), (data, False))
+        self.assertTrue(self.compressor.given_up)
+        self.assertIsNone(self.compressor.compressor)
+        self.assertEqual(self.send(TEXT[:4096]), (TEXT[:4096], False))
+
+    def test_given_up_after_probe(self):
+        # compressible at first, then random for good
+        self.assertEqual(self.send(TEXT[:2048]), (TEXT[:2048], True))
+        sent = []
+        for i in range(40):
+            sent.append(self.send(os.urandom(1024))[1])
+        self.assertTrue(self.compressor.given_up)
+        self.assertIn(False, sent)
+        self.assertEqual(sent[sent.index(False):],
+                         [False] * (len(sent) - sent.index(False)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import threading
+import unittest
+
+import direct
+from eventloop import EventLoop
+
+def _tcp_pair(listener):
+    client = socket.create_connection(listener.getsockname())
+    server, addr = listener.accept()
+    return client, server
+
+def _read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+class RelayTest(unittest.TestCase):
+
+    size = 4 * 1024 * 1024
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(2)
+        self.splice = direct._splice
+
+    def tearDown(self):
+        direct._splice = self.splice
+        self.listener.close()
+
+    def relay(self):
+        # client <-> a [Relay] b <-> upstream
+        client, a = _tcp_pair(self.listener)
+        b, upstream = _tcp_pair(self.listener)
+        up, down = os.urandom(self.size), os.urandom(self.size // 2)
+        got = {}
+
+        def run_client():
+            client.sendall(up)
+            client.shutdown(socket.SHUT_WR)
+            got['down'] = _read_all(client)
+
+        def run_upstream():
+            got['up'] = _read_all(upstream)
+            upstream.sendall(down)
+            upstream.shutdown(socket.SHUT_WR)
+
+        threads = [threading.Thread(target=run_client),
+                   threading.Thread(target=run_upstream)]
+        [t.start() for t in threads]
+        loop = EventLoop()
+        a.setblocking(0)
+        b.setblocking(0)
+        # early client bytes and the socks5 reply go first
+        relay = direct.Relay(loop, a, b, b'early', b'reply')
+        loop.run()      # until both directions are done
+        [t.join(10) for t in threads]
+        client.close()
+        upstream.close()
+
+        self.assertTrue(relay.closed)
+        self.assertEqual(got['up'], b'early' + up)
+        self.assertEqual(got['down'], b'reply' + down)
+        self.assertEqual(relay.links[0].count, self.size)
+        self.assertEqual(relay.links[1].count, self.size // 2)
+        return relay
+
+    def test_copy(self):
+        direct._splice = None
+        relay = self.relay()
+        self.assertIsInstance(relay.links[0], direct._CopyLink)
+
+    @unittest.skipIf(direct._splice is None, 'no os.splice')
+    def test_splice(self):
+        relay = self.relay()
+        self.assertIsInstance(relay.links[0], direct._SpliceLink)
+
+    def test_upstream_reset_before_relay(self):
+        client, a = _tcp_pair(self.listener)
+        b, upstream = _tcp_pair(self.listener)
+        upstream.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            b'\x01\x00\x00\x00\x00\x00\x00\x00')
+        upstream.close()    # RST, b has no peer anymore
+        a.setblocking(0)
+        b.setblocking(0)
+        loop = EventLoop()
+        relay = direct.Relay(loop, a, b, addr=('127.0.0.1', 1))
+        loop.run()
+        client.close()
+        self.assertTrue(relay.closed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from eventloop import EventLoop
+
+class TimerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def test_order(self):
+        fired = []
+        for delay in (0.02, 0, 0.01):
+            self.loop.call_later(delay, fired.append, delay)
+        self.loop.run()
+        self.assertEqual(fired, [0, 0.01, 0.02])
+
+    def test_cancel(self):
+        fired = []
+        self.loop.call_later(0, fired.append, 1).cancel()
+        self.loop.call_later(0, fired.append, 2)
+        self.loop.run()
+        self.assertEqual(fired, [2])
+        self.assertEqual(self.loop.cancelled, 0)
+
+    def test_cancel_many_from_due_callback(self):
+        # enough cancellations to compact the heap while `_run_timers` is
+        # still popping due timers from it
+        fired = []
+        later = [self.loop.call_later(0.01, fired.append, 'later')
+                 for i in range(100)]
+
+        def cancel_later():
+            fired.append('cancel')
+            for timer in later:
+                timer.cancel()
+
+        self.loop.call_later(0, cancel_later)
+        for i in range(3):
+            self.loop.call_later(0, fired.append, i)
+            self.loop.call_later(0, fired.append, 'cancelled').cancel()
+        self.loop.run()     # returns once no timer is left
+        self.assertEqual(fired, ['cancel', 0, 1, 2])
+        # whatever is left in the heap is accounted for as cancelled
+        self.assertEqual(len(self.loop.timers), self.loop.cancelled)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import unittest
+
+import metrics
+from eventloop import EventLoop
+
+class MetricsServerTest(unittest.TestCase):
+    def get(self, path):
+        # one request to a `MetricsServer` on its own loop, from a thread
+        loop = EventLoop()
+        server = metrics.MetricsServer(('127.0.0.1', 0))
+        self.assertTrue(server.Start(loop))
+        addr = server.sock.getsockname()
+        response = []
+
+        def client():
+            sock = socket.create_connection(addr, timeout=5)
+            sock.sendall(b'GET ' + path + b' HTTP/1.0\r\n\r\n')
+            chunks = iter(lambda: sock.recv(65536), b'')
+            response.append(b''.join(chunks))
+            sock.close()
+
+        def drain_when_done():
+            if thread.is_alive():
+                loop.call_later(0.01, drain_when_done)
+            else:
+                server.Drain()
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        loop.call_later(0.01, drain_when_done)
+        loop.run()
+        thread.join()
+        head, body = response[0].split(b'\r\n\r\n', 1)
+        return head.split(b'\r\n'), body
+
+    def test_scrape(self):
+        metrics.STREAMS_OPENED.inc()
+        head, body = self.get(b'/metrics')
+        self.assertEqual(head[0], b'HTTP/1.0 200 OK')
+        self.assertIn(b'Content-Length: %d' % len(body), head)
+        self.assertIn(b'\npysocks5_streams_opened_total ', body)
+        self.assertIn(b'# TYPE pysocks5_loop_iteration_seconds histogram\n',
+                      body)
+
+    def test_not_found(self):
+        head, body = self.get(b'/other')
+        self.assertEqual(head[0], b'HTTP/1.0 404 Not Found')
+        self.assertEqual(body, b'not found\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+from eventloop import EventLoop
+from resolver import Resolver, QTYPE_A, QTYPE_AAAA, RCODE_NXDOMAIN, \
+                     read_resolv_conf
+
+def _question(query):
+    # (qid, qname, qtype, end of the question section)
+    query = bytearray(query)
+    i, labels = 12, []
+    while query[i]:
+        labels.append(bytes(query[i+1:i+1+query[i]]))
+        i += query[i] + 1
+    qtype = struct.unpack('>H', bytes(query[i+1:i+3]))[0]
+    return struct.unpack('>H', bytes(query[:2]))[0], b'.'.join(labels), \
+        qtype, i + 5
+
+def response(query, addrs=(), rcode=0, ttl=60, qid=None):
+    qid_, qname, qtype, end = _question(query)
+    msg = struct.pack('>HHHHHH', qid_ if qid is None else qid,
+                      0x8180 | rcode, 1, len(addrs), 0, 0)
+    msg += bytes(bytearray(query)[12:end])
+    for addr in addrs:
+        family = socket.AF_INET6 if ':' in addr else socket.AF_INET
+        rdata = socket.inet_pton(family, addr)
+        msg += struct.pack('>HHHIH', 0xc00c, qtype, 1, ttl, len(rdata))
+        msg += rdata
+    return msg
+
+def _has_ipv6():
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        sock.bind(('::1', 0))
+    except socket.error:
+        return False
+    sock.close()
+    return True
+
+class StubServer(object):
+    """A nameserver on `ip` answering from a thread, `handler(query,
+    qname, qtype)` returns the datagrams to send back"""
+
+    def __init__(self, handler, ip='127.0.0.1'):
+        self.handler = handler
+        self.received = []      # (qid, qname, qtype, source port)
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind((ip, 0))
+        self.addr = self.sock.getsockname()[:2]
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                query, addr = self.sock.recvfrom(4096)
+            except socket.error:
+                return      # closed
+            qid, qname, qtype, end = _question(query)
+            self.received.append((qid, qname, qtype, addr[1]))
+            for msg in self.handler(query, qname, qtype):
+                self.sock.sendto(msg, addr)
+
+    def close(self):
+        self.sock.close()
+
+A = {b'v4.test': ['192.0.2.1', '192.0.2.2'], b'dual.test': ['192.0.2.3']}
+AAAA = {b'dual.test': ['2001:db8::3']}
+
+def answer(query, qname, qtype):
+    if qname.startswith(b'silent'):
+        return []
+    records = (A if qtype == QTYPE_A else AAAA).get(qname)
+    if records is None and qname not in A and qname not in AAAA:
+        return [response(query, rcode=RCODE_NXDOMAIN)]
+    return [response(query, records or ())]
+
+class StubTest(object):
+    # a resolver using a `StubServer` that answers with `self.handler`
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.server = StubServer(self.handler)
+        self.resolver = Resolver(self.loop, [self.server.addr], timeout=0.1,
+                                 tries=2, hosts={}, ipv6=True)
+
+    def tearDown(self):
+        self.server.close()
+
+    def resolve(self, host):
+        results = []
+        self.resolver.Resolve(host, results.append)
+        self.loop.run()
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+class ResolverTest(StubTest, unittest.TestCase):
+
+    handler = staticmethod(answer)
+
+    def test_a(self):
+        self.assertEqual(self.resolve(b'v4.test'), ['192.0.2.1', '192.0.2.2'])
+
+    def test_a_and_aaaa(self):
+        # IPv6 first
+        self.assertEqual(self.resolve(b'dual.test'),
+                         ['2001:db8::3', '192.0.2.3'])
+        qtypes = sorted(qtype for qid, qname, qtype, port
+                        in self.server.received)
+        self.assertEqual(qtypes, [QTYPE_A, QTYPE_AAAA])
+
+    def test_fresh_source_port_per_query(self):
+        for name in (b'v4.test', b'dual.test'):
+            self.resolve(name)
+        ports = [port for qid, qname, qtype, port in self.server.received]
+        self.assertEqual(len(ports), 4)
+        self.assertEqual(len(set(ports)), 4)
+
+    def test_nxdomain_is_cached(self):
+        self.assertEqual(self.resolve(b'missing.test'), [])
+        received = len(self.server.received)
+        self.assertEqual(self.resolve(b'missing.test'), [])
+        self.assertEqual(len(self.server.received), received)
+
+    def test_answers_are_cached(self):
+        self.resolve(b'v4.test')
+        received = len(self.server.received)
+        self.assertEqual(self.resolve(b'V4.test.'), ['192.0.2.1', '192.0.2.2'])
+        self.assertEqual(len(self.server.received), received)
+
+    def test_timeout(self):
+        self.assertEqual(self.resolve(b'silent.test'), [])
+        # both qtypes, each tried `tries` times
+        self.assertEqual(len(self.server.received), 4)
+
+    def test_undecodable_name(self):
+        # straight from a socks5 request, must fail the lookup, not raise
+        self.assertEqual(self.resolve(b'\xff.co'), [])
+        self.assertEqual(self.server.received, [])
+
+    def test_bad_label(self):
+        self.assertEqual(self.resolve(b'a' * 64 + b'.co'), [])
+        self.assertEqual(self.resolve(b'a..co'), [])
+
+    def test_literals(self):
+        self.assertEqual(self.resolve(b'127.0.0.1'), ['127.0.0.1'])
+        self.assertEqual(self.resolve(b'::1'), ['::1'])
+
+class RetryTest(StubTest, unittest.TestCase):
+    # every first query goes unanswered, the retry gets the answer
+    def handler(self, query, qname, qtype):
+        seen = self.seen.setdefault((qname, qtype), [])
+        seen.append(query)
+        return answer(query, qname, qtype) if len(seen) > 1 else []
+
+    def setUp(self):
+        self.seen = {}
+        StubTest.setUp(self)
+
+    def test_retry(self):
+        self.assertEqual(self.resolve(b'v4.test'), ['192.0.2.1', '192.0.2.2'])
+        received = [(qname, qtype) for qid, qname, qtype, port
+                    in self.server.received]
+        self.assertEqual(received.count((b'v4.test', QTYPE_A)), 2)
+
+class MalformedTest(StubTest, unittest.TestCase):
+    # garbage and answers to other ids come first and must be skipped
+    def handler(self, query, qname, qtype):
+        qid = struct.unpack('>H', query[:2])[0]
+        forged = response(query, ['203.0.113.66'], qid=qid ^ 1)
+        return [b'\x00', query[:20], b'\xff' * 40, forged] + \
+            answer(query, qname, qtype)
+
+    def test_forged_id_ignored(self):
+        self.assertEqual(self.resolve(b'dual.test'),
+                         ['2001:db8::3', '192.0.2.3'])
+
+class NameserverTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def server(self, handler=answer, ip='127.0.0.1'):
+        server = StubServer(handler, ip)
+        self.servers.append(server)
+        return server
+
+    def resolve(self, nameservers, host=b'v4.test'):
+        resolver = Resolver(self.loop, nameservers, timeout=0.1, tries=1,
+                            hosts={}, ipv6=False)
+        results = []
+        resolver.Resolve(host, results.append)
+        self.loop.run()
+        return results
+
+    def test_nameservers_as_lists(self):
+        # e.g. from PYSOCKS5_NAMESERVERS="[['127.0.0.1', 53]]"
+        addr = self.server().addr
+        self.assertEqual(self.resolve([list(addr)]),
+                         [['192.0.2.1', '192.0.2.2']])
+
+    @unittest.skipUnless(_has_ipv6(), 'no IPv6')
+    def test_ipv6_nameserver(self):
+        ip, port = self.server(ip='::1').addr
+        self.assertEqual(self.resolve([('0::1', port)]),
+                         [['192.0.2.1', '192.0.2.2']])
+
+    @unittest.skipUnless(_has_ipv6(), 'no IPv6')
+    def test_retry_to_the_other_family(self):
+        silent = self.server(lambda query, qname, qtype: [], ip='::1')
+        server = self.server()
+        self.assertEqual(self.resolve([silent.addr, server.addr]),
+                         [['192.0.2.1', '192.0.2.2']])
+        self.assertEqual(len(silent.received), 1)
+
+    def test_read_resolv_conf(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'resolv.conf')
+            with open(path, 'w') as f:
+                f.write('# comment\nnameserver 192.0.2.53\n'
+                        'nameserver 2001:db8::53\n'
+                        'nameserver fe80::1%eth0\n'
+                        'nameserver bogus\nsearch test\n')
+            self.assertEqual(read_resolv_conf(path),
+                             [('192.0.2.53', 53), ('2001:db8::53', 53),
+                              ('fe80::1%eth0', 53)])
+        finally:
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    unittest.main()
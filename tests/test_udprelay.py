@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import unittest
+
+import socks5
+from eventloop import EventLoop
+from udprelay import Association
+
+class _Resolver(object):
+    def __init__(self, addrs):
+        self.addrs = addrs
+
+    def Resolve(self, host, callback):
+        callback(self.addrs)
+
+class AssociationTest(unittest.TestCase):
+    def test_falls_back_to_the_next_address(self):
+        dest = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        dest.bind(('127.0.0.1', 0))
+        dest.settimeout(5)
+        port = dest.getsockname()[1]
+        # a send to the broadcast address fails right away, standing in
+        # for an AAAA address on a host without IPv6
+        resolver = _Resolver(['255.255.255.255', '127.0.0.1'])
+        assoc = Association(EventLoop(), resolver, lambda payload: None)
+        try:
+            assoc.Send(socks5.pack_address(('127.0.0.1', port)) + b'ping')
+            self.assertEqual(dest.recvfrom(100)[0], b'ping')
+            self.assertEqual(list(assoc.peers), [('127.0.0.1', port)])
+        finally:
+            assoc.Cancel()
+            dest.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import unittest
+
+from eventloop import EventLoop
+from warmpool import WarmPool
+
+class WarmPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.addr = self.listener.getsockname()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_only_hot_destinations_are_warmed(self):
+        pool = WarmPool(self.loop, 2, idle=0.1, max_age=0.05, hot=3)
+        pool.Used(self.addr)
+        pool.Used(self.addr)
+        self.assertEqual(pool.socks, {})
+        pool.Used(self.addr)
+        self.assertEqual(len(pool.socks[self.addr]), 2)
+        # kept warm while used, dropped and forgotten once idle
+        self.loop.run()
+        self.assertEqual(pool.socks, {})
+        self.assertEqual(pool.uses, {})
+
+    def test_one_off_destinations_are_forgotten(self):
+        pool = WarmPool(self.loop, 1, idle=0.05, max_age=0.05, hot=1)
+        pool.max_hosts, pool.max_tracked = 2, 100
+        # refused ports, beyond max_hosts and beyond max_tracked
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        for i in range(500):
+            pool.Used(('127.0.0.1', port))
+            pool.Used(('127.0.0.%d' % (i % 250 + 2), port))
+        self.assertLessEqual(len(pool.socks), 2)
+        self.assertEqual(len(pool.uses), 100)
+        self.loop.run()
+        self.assertEqual(pool.socks, {})
+        self.assertEqual(pool.uses, {})
+
+if __name__ == '__main__':
+    unittest.main()